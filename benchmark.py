@@ -0,0 +1,362 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+
+# benchmark of the midi2video rendering hot paths with synthetic midi files
+# usage: ./benchmark.py [--scale 0.2] [--scenario chords] [--output results.json] [--compare old.json]
+#        ./benchmark.py --encoderProfiles draft web lossless --midiFile example.mid
+
+import argparse
+import configparser
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import struct
+import subprocess
+import sys
+import time
+from pathlib import Path
+from shutil import rmtree
+
+import midi2video
+from midi2video import Map, Midi2Video, ENCODER_PROFILES
+
+'''
+    writes a format 0 standard midi file
+    notes is a list of (startTick, durationTicks, noteNumber, velocity)
+'''
+def writeMidiFile(filePath, notes, ticksPerBeat=480, tempo=500000):
+    events = []
+    for startTick, durationTicks, noteNumber, velocity in notes:
+        events.append((startTick, 1, bytes([0x90, noteNumber, velocity])))
+        events.append((startTick + durationTicks, 0, bytes([0x80, noteNumber, 0])))
+    # note offs before note ons of the same tick
+    events.sort(key=lambda event: (event[0], event[1]))
+
+    trackData = bytearray(writeVarLen(0) + b'\xff\x51\x03' + tempo.to_bytes(3, 'big'))
+    lastTick = 0
+    for tick, isNoteOn, eventData in events:
+        trackData += writeVarLen(tick - lastTick) + eventData
+        lastTick = tick
+    trackData += writeVarLen(0) + b'\xff\x2f\x00'
+
+    header = b'MThd' + struct.pack('>LHHH', 6, 0, 1, ticksPerBeat)
+    Path(filePath).write_bytes(header + b'MTrk' + struct.pack('>L', len(trackData)) + trackData)
+
+def writeVarLen(value):
+    varLen = [value & 0x7F]
+    value >>= 7
+    while value:
+        varLen.insert(0, (value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(varLen)
+
+# all generators return notes for given amount of seconds at 120 BPM (480 ticks per beat)
+def generateMelody(seconds, seed):
+    rng = random.Random(seed)
+    notes = []
+    tick = 0
+    while tick < seconds * 960:
+        duration = rng.choice([120, 240, 240, 480, 960])
+        # right hand melody and left hand bass
+        notes.append((tick, duration, rng.randint(60, 84), rng.randint(50, 110)))
+        if tick % 960 == 0:
+            notes.append((tick, 960, rng.randint(36, 55), rng.randint(40, 90)))
+        tick += duration
+    return notes
+
+def generateChords(seconds, seed):
+    rng = random.Random(seed)
+    notes = []
+    for tick in range(0, int(seconds * 960), 480):
+        root = rng.randint(36, 60)
+        # ten fingers
+        chord = sorted(set(root + rng.choice([0, 3, 4, 7, 10, 12, 15, 16, 19, 24, 28]) for i in range(16)))[:10]
+        for noteNumber in chord:
+            notes.append((tick, rng.choice([240, 360, 470]), noteNumber, rng.randint(40, 120)))
+    return notes
+
+def generateTrills(seconds, seed):
+    rng = random.Random(seed)
+    notes = []
+    noteNumber = 60
+    for tick in range(0, int(seconds * 960), 60):
+        # 32th notes alternating between two neighbours. move the trill every bar
+        if tick % 1920 == 0:
+            noteNumber = rng.randint(40, 90)
+        notes.append((tick, 55, noteNumber + (tick // 60) % 2, rng.randint(60, 100)))
+    return notes
+
+def generateFullRange(seconds, seed):
+    rng = random.Random(seed)
+    notes = []
+    tick = 0
+    while tick < seconds * 960:
+        # arpeggios up and down all 88 keys
+        for noteNumber in list(range(21, 109, 3)) + list(range(108, 20, -3)):
+            notes.append((tick, 240, noteNumber, rng.randint(50, 100)))
+            tick += 30
+    return notes
+
+SCENARIOS = [
+    Map({ 'name': 'long', 'generator': generateMelody, 'seconds': 1200 }),
+    Map({ 'name': 'chords', 'generator': generateChords, 'seconds': 120 }),
+    Map({ 'name': 'trills', 'generator': generateTrills, 'seconds': 120 }),
+    Map({ 'name': 'fullRange', 'generator': generateFullRange, 'seconds': 120 }),
+    Map({ 'name': 'fades', 'generator': generateMelody, 'seconds': 120, 'noteFadeIn': '1', 'noteFadeOut': '1' }),
+    Map({ 'name': 'highFrameRate', 'generator': generateMelody, 'seconds': 120, 'frameRate': 120 }),
+    Map({ 'name': 'largeResolution', 'generator': generateChords, 'seconds': 60, 'width': 3840, 'height': 480 }),
+]
+
+def createScenarioConfig(scenario, notes, args, velocityLevels=1):
+    config = configparser.ConfigParser(strict=False)
+    config.read_dict({
+        'video': {
+            'width': str(scenario.width or 1920),
+            'height': str(scenario.height or 240),
+            'frameRate': str(scenario.frameRate or 30),
+            'noteFadeIn': scenario.noteFadeIn or '0',
+            'noteFadeOut': scenario.noteFadeOut or '0',
+            'renderEngine': args.renderEngine,
+            'workers': str(args.workers),
+            'streamFrames': '1',
+            'addAudio': '0'
+        },
+        # measure rendering, not cache hits
+        'cache': { 'frameCacheDir': '' },
+        'piano': {
+            'startNote': str(min(note[2] for note in notes)),
+            'endNote': str(max(note[2] for note in notes)),
+            'velocityLevels': str(velocityLevels)
+        }
+    })
+    return config
+
+def measurePhase(phases, name, function):
+    startTime = time.perf_counter()
+    result = function()
+    phases[name] = time.perf_counter() - startTime
+    return result
+
+# runs in a fresh process so that peak memory belongs to this scenario only
+def runScenario(scenarioName, args, velocityLevels=1):
+    logging.getLogger().setLevel(logging.WARNING)
+    scenario = next(scenario for scenario in SCENARIOS if scenario.name == scenarioName)
+    notes = scenario.generator(scenario.seconds * args.scale, seed=args.seed)
+
+    outputDir = Path(args.workDir).resolve()
+    outputDir.mkdir(parents=True, exist_ok=True)
+    midiFile = Path('%s/bench-%s.mid' % (outputDir, scenario.name))
+    writeMidiFile(midiFile, notes)
+
+    config = createScenarioConfig(scenario, notes, args, velocityLevels)
+    m2v = Midi2Video(outputDir, config)
+    m2v.midiFile = midiFile
+    m2v.createTempDir()
+
+    phases = {}
+    measurePhase(phases, 'prepareNoteEvents', m2v.prepareNoteEvents)
+    if measurePhase(phases, 'validateConfig', lambda: midi2video.validateConfig(m2v, config)) != True:
+        raise RuntimeError('invalid benchmark config for %s' % scenario.name)
+    m2v.createTempSubDirs()
+
+    # updateActiveNotesForFrame + frame composition of every frame
+    measurePhase(phases, 'collectFrameStates', m2v.collectFrameStates)
+
+    def renderAll():
+        rawOutput = m2v.renderEngine == 'sprite'
+        for frameData in m2v.renderFrameStates(m2v.frameStates, rawOutput):
+            pass
+    measurePhase(phases, 'renderFrames', renderAll)
+
+    if args.encode:
+        # complete render and ffmpeg pipeline of a fresh instance
+        m2vEncode = Midi2Video(outputDir, config)
+        m2vEncode.midiFile = midiFile
+        m2vEncode.createTempDir()
+        m2vEncode.prepareNoteEvents()
+        midi2video.validateConfig(m2vEncode, config)
+        m2vEncode.createTempSubDirs()
+        measurePhase(phases, 'createVideo', m2vEncode.createVideo)
+        rmtree(m2vEncode.tempDir.resolve(), ignore_errors=True)
+
+    rmtree(m2v.tempDir.resolve(), ignore_errors=True)
+    frameSeconds = phases['collectFrameStates'] + phases['renderFrames']
+    return {
+        # scenarios with velocity levels are separate entries for --compare
+        'scenario': scenario.name if velocityLevels == 1 else '%s/v%i' % (scenario.name, velocityLevels),
+        'velocityLevels': velocityLevels,
+        'notes': len(notes),
+        'width': m2v.videoWidth,
+        'height': m2v.videoHeight,
+        'frameRate': m2v.framesPerSecond,
+        'keys': len(m2v.piano.keyLayout),
+        'totalFrames': m2v.videoTotalFrames,
+        'uniqueFrames': len(m2v.frameStates),
+        'uniqueFrameRatio': len(m2v.frameStates) / max(1, m2v.videoTotalFrames),
+        'framesPerSecond': m2v.videoTotalFrames / frameSeconds if frameSeconds else 0,
+        'phases': phases,
+        'counters': dict(m2v.stats.counters),
+        # kilobytes on linux, bytes on macos
+        'peakMemoryMB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    }
+
+'''
+    encodes given midi file with each encoder profile. the frames are rendered only once
+    to a frame cache so the timings are those of ffmpeg
+'''
+def runEncoderProfile(profile, args):
+    logging.getLogger().setLevel(logging.WARNING)
+    outputDir = Path(args.workDir).resolve()
+    outputDir.mkdir(parents=True, exist_ok=True)
+
+    config = midi2video.loadConfig(Path(os.path.dirname(os.path.abspath(__file__))))
+    # frame files, so rendering and encoding are separate phases. the piano roll would stream
+    config.read_dict({
+        'video': { 'streamFrames': '0', 'addAudio': '0', 'workers': str(args.workers) },
+        'pianoRoll': { 'enabled': '0' },
+        'cache': { 'frameCacheDir': str(outputDir / 'frame-cache') },
+        'encoder': { 'profile': profile }
+    })
+    m2v = Midi2Video(outputDir, config)
+    m2v.midiFile = args.midiFile.resolve()
+    m2v.createTempDir()
+    if midi2video.validateConfig(m2v, config) != True:
+        raise RuntimeError('invalid config for encoder profile %s' % profile)
+    m2v.createTempSubDirs()
+
+    startTime = time.perf_counter()
+    m2v.createVideo()
+    phases = m2v.stats.phases
+    encodeSeconds = time.perf_counter() - startTime - phases.get('collectFrameStates', 0) - phases.get('createSingleFrames', 0)
+    videoPath = m2v.getOutputPath(m2v.encoder.container)
+    rmtree(m2v.tempDir.resolve(), ignore_errors=True)
+    return {
+        'profile': profile,
+        'codec': m2v.encoder.codec,
+        'totalFrames': m2v.videoTotalFrames,
+        'encodeSeconds': encodeSeconds,
+        'encodeFramesPerSecond': m2v.videoTotalFrames / encodeSeconds if encodeSeconds else 0,
+        'fileSize': videoPath.stat().st_size,
+        'kbitPerSecond': videoPath.stat().st_size * 8 / 1000 / (m2v.videoTotalFrames / m2v.framesPerSecond),
+        'failedCommands': [ command['description'] for command in m2v.stats.commands if command['returnCode'] != 0 ]
+    }
+
+def printEncoderResults(results):
+    print ( '%-10s %-10s %8s %9s %10s %10s' % ('profile', 'codec', 'seconds', 'frames/s', 'size MB', 'kbit/s') )
+    for result in results:
+        print ( '%-10s %-10s %8.2f %9.1f %10.2f %10.1f%s' % (
+            result['profile'],
+            result['codec'],
+            result['encodeSeconds'],
+            result['encodeFramesPerSecond'],
+            result['fileSize'] / (1024 * 1024),
+            result['kbitPerSecond'],
+            '  FAILED' if result['failedCommands'] else ''
+        ))
+
+def getVersion():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        ).stdout.decode('utf-8').strip()
+    except OSError:
+        return ''
+
+def printResults(results, compareResults=None):
+    previous = {}
+    if compareResults:
+        previous = { result['scenario']: result for result in compareResults['scenarios'] }
+
+    print ( '%-20s %8s %8s %7s %9s %8s %8s %8s %8s  %s' % (
+        'scenario', 'frames', 'unique', 'ratio', 'frames/s', 'parse', 'states', 'render', 'peakMB', 'vs. compare'
+    ))
+    for result in results:
+        comparison = ''
+        if result['scenario'] in previous and previous[result['scenario']]['framesPerSecond']:
+            comparison = '%.2fx' % (result['framesPerSecond'] / previous[result['scenario']]['framesPerSecond'])
+        print ( '%-20s %8i %8i %7.3f %9.1f %8.3f %8.3f %8.3f %8.1f  %s' % (
+            result['scenario'],
+            result['totalFrames'],
+            result['uniqueFrames'],
+            result['uniqueFrameRatio'],
+            result['framesPerSecond'],
+            result['phases']['prepareNoteEvents'],
+            result['phases']['collectFrameStates'],
+            result['phases']['renderFrames'],
+            result['peakMemoryMB'],
+            comparison
+        ))
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark midi2video with synthetic midi files')
+    parser.add_argument('--scenario', action='append', choices=[ scenario.name for scenario in SCENARIOS ],
+        help='run only given scenario (can be used multiple times)')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier for the duration of all scenarios')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the synthetic midi generator')
+    parser.add_argument('--renderEngine', default='sprite', choices=['sprite', 'svg'])
+    parser.add_argument('--workers', type=int, default=1, help='frame render processes')
+    parser.add_argument('--encode', action='store_true', help='additionally measure the complete pipeline including ffmpeg')
+    parser.add_argument('--workDir', default='benchmark-temp', help='directory for generated midi files and videos')
+    parser.add_argument('--output', type=Path, help='write the results as json to this file')
+    parser.add_argument('--compare', type=Path, help='json results of a previous run to compare with')
+    parser.add_argument('--encoderProfiles', nargs='*', choices=list(ENCODER_PROFILES),
+        help='encoder benchmark: encode --midiFile with given profiles (all when none given) instead of the scenarios')
+    parser.add_argument('--midiFile', type=Path, help='midi file for the encoder benchmark')
+    parser.add_argument('--velocityLevels', type=int, nargs='+', default=[1],
+        help='velocity levels of the highlight color. every scenario runs once per given amount')
+    args = parser.parse_args()
+
+    if args.encoderProfiles is not None:
+        if not args.midiFile or not args.midiFile.is_file():
+            parser.error('--encoderProfiles requires an existing --midiFile')
+        results = []
+        for profile in args.encoderProfiles or list(ENCODER_PROFILES):
+            print ( 'encoding with profile %s...' % profile, end='\r' )
+            sys.stdout.flush()
+            results.append(runEncoderProfile(profile, args))
+        printEncoderResults(results)
+        if args.output:
+            args.output.write_text(json.dumps({
+                'version': getVersion(),
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'midiFile': str(args.midiFile.resolve()),
+                'profiles': results
+            }, indent=2))
+        return
+
+    scenarioNames = args.scenario or [ scenario.name for scenario in SCENARIOS ]
+    results = []
+    for scenarioName in scenarioNames:
+        for velocityLevels in args.velocityLevels:
+            print ( 'running scenario %s...' % scenarioName, end='\r' )
+            sys.stdout.flush()
+            with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+                results.append(pool.apply(runScenario, (scenarioName, args, velocityLevels)))
+
+    compareResults = json.loads(args.compare.read_text()) if args.compare else None
+    printResults(results, compareResults)
+
+    if args.output:
+        args.output.write_text(json.dumps({
+            'version': getVersion(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'settings': {
+                'scale': args.scale,
+                'seed': args.seed,
+                'renderEngine': args.renderEngine,
+                'workers': args.workers,
+                'velocityLevels': args.velocityLevels
+            },
+            'scenarios': results
+        }, indent=2))
+
+if __name__ == '__main__':
+    main()
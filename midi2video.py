@@ -1,23 +1,39 @@
 #!/bin/env python3
 # -*- coding: utf-8 -*- 
 
-# limitiations
-# tempo changes are not supported
-
 # @see https://github.com/vishnubob/python-midi/pull/62/commits/9aa092e653684c871b9ee2293ee8e640bb1cab34
 import argparse
+import json
 import logging
 import subprocess
 import configparser
-import mydy as midi
 import sys
 import math
 import os
 import time
+import tempfile
+import io
+import array
+import mmap
+import hashlib
+import multiprocessing
+import multiprocessing.pool
+import threading
+import queue
+import socket
+import socketserver
+import http.server
+import base64
+import cProfile
+import pstats
+import numpy
+from collections import OrderedDict, namedtuple, deque
+from contextlib import contextmanager
 from pathlib import Path
 from shutil import rmtree, copyfile
 from colorsys import rgb_to_hls, hls_to_rgb
 from cairosvg import svg2png
+from PIL import Image
 
 # https://stackoverflow.com/questions/2352181/how-to-use-a-dot-to-access-members-of-dictionary
 class Map(dict):
@@ -34,16 +50,192 @@ class Map(dict):
         self.update(state)
         self.__dict__ = self
 
+class MidiFileReader(object):
+    '''
+        minimal streaming reader of standard midi files. tracks are scanned directly
+        from the memory mapped file. only note on/off and set tempo events get decoded
+        everything else is skipped by its length
+    '''
+    NOTE_OFF = 0
+    NOTE_ON = 1
+    SET_TEMPO = 2
+    TIME_SIGNATURE = 3
+
+    # amount of data bytes of channel messages by status nibble
+    channelDataLength = { 0x80: 2, 0x90: 2, 0xA0: 2, 0xB0: 2, 0xC0: 1, 0xD0: 1, 0xE0: 2 }
+
+    def __init__(self, filePath, fixTrackLength=False):
+        self.filePath = filePath
+        # ignore the declared track length and read until the end of track event (or the end of the file)
+        # some recorders never update the length of the track they are writing to
+        self.fixTrackLength = fixTrackLength
+
+        with open(self.filePath, 'rb') as midiFile:
+            header = midiFile.read(14)
+        if len(header) < 14 or header[0:4] != b'MThd':
+            raise ValueError('%s is not a standard midi file' % self.filePath)
+        self.headerLength = int.from_bytes(header[4:8], 'big')
+        self.trackCount = int.from_bytes(header[10:12], 'big')
+        division = int.from_bytes(header[12:14], 'big')
+        if division & 0x8000:
+            raise ValueError('%s uses SMPTE time division which is not supported' % self.filePath)
+        self.ticksPerBeat = division
+
+    '''
+        yields (trackNumber, tick, eventType, value1, value2, channel) in file order. ticks
+        are absolute within the track. value1/value2 are note number/velocity, the tempo
+        in microseconds per quarter note (value2 is 0 then) or the numerator and the
+        power of two of the denominator of a time signature. channel is 0 for meta events
+    '''
+    def readEvents(self):
+        with open(self.filePath, 'rb') as midiFile:
+            with mmap.mmap(midiFile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                position = 8 + self.headerLength
+                trackNumber = 0
+                while position + 8 <= len(data):
+                    chunkType = data[position:position+4]
+                    chunkLength = int.from_bytes(data[position+4:position+8], 'big')
+                    position += 8
+                    if chunkType != b'MTrk':
+                        position += chunkLength
+                        continue
+
+                    # truncated files end within the track
+                    trackEnd = min(position + chunkLength, len(data))
+                    if self.fixTrackLength:
+                        trackEnd = len(data)
+                    endOfTrack = yield from self.readTrackEvents(data, position, trackEnd, trackNumber)
+                    position = endOfTrack if self.fixTrackLength else trackEnd
+                    trackNumber += 1
+
+    # returns the position after the last read event
+    def readTrackEvents(self, data, position, trackEnd, trackNumber):
+        tick = 0
+        runningStatus = 0
+        try:
+            while position < trackEnd:
+                # variable length delta time
+                delta = 0
+                while True:
+                    byte = data[position]
+                    position += 1
+                    delta = (delta << 7) | (byte & 0x7F)
+                    if byte < 0x80:
+                        break
+                tick += delta
+
+                status = data[position]
+                if status < 0x80:
+                    # running status. the byte already belongs to the data
+                    status = runningStatus
+                else:
+                    position += 1
+
+                if status == 0xFF:
+                    metaType = data[position]
+                    metaLength, position = self.readVarLen(data, position + 1)
+                    if metaType == 0x51 and metaLength == 3:
+                        yield (trackNumber, tick, self.SET_TEMPO, int.from_bytes(data[position:position+3], 'big'), 0, 0)
+                    elif metaType == 0x58 and metaLength == 4:
+                        yield (trackNumber, tick, self.TIME_SIGNATURE, data[position], data[position+1], 0)
+                    position += metaLength
+                    runningStatus = 0
+                    if metaType == 0x2F:
+                        # end of track
+                        return position
+                    continue
+
+                if status in (0xF0, 0xF7):
+                    sysexLength, position = self.readVarLen(data, position)
+                    position += sysexLength
+                    runningStatus = 0
+                    continue
+
+                if status < 0x80:
+                    # data byte without running status
+                    return trackEnd
+
+                runningStatus = status
+                messageType = status & 0xF0
+                if messageType == 0x90 or messageType == 0x80:
+                    noteNumber = data[position]
+                    velocity = data[position+1]
+                    position += 2
+                    if position > trackEnd:
+                        break
+                    if messageType == 0x90:
+                        yield (trackNumber, tick, self.NOTE_ON, noteNumber, velocity, status & 0x0F)
+                    else:
+                        yield (trackNumber, tick, self.NOTE_OFF, noteNumber, velocity, status & 0x0F)
+                    continue
+
+                position += self.channelDataLength.get(messageType, 0)
+        except IndexError:
+            # the file ends in the middle of an event
+            pass
+        return trackEnd
+
+    def readVarLen(self, data, position):
+        value = 0
+        while True:
+            byte = data[position]
+            position += 1
+            value = (value << 7) | (byte & 0x7F)
+            if byte < 0x80:
+                return value, position
+
+
+class TempoMap(object):
+    '''
+        piecewise linear tick to time conversion. each tempo event starts a segment
+        with the microseconds at its start tick. 120 BPM until the first tempo event
+    '''
+    def __init__(self, ticksPerBeat, tempoTicks, tempos):
+        self.ticksPerBeat = ticksPerBeat
+        tempoTicks = numpy.asarray(tempoTicks, dtype=numpy.int64)
+        tempos = numpy.asarray(tempos, dtype=numpy.float64)
+
+        # stable so the last of several tempo events at the same tick wins
+        order = numpy.argsort(tempoTicks, kind='stable')
+        tempoTicks = numpy.concatenate(([0], tempoTicks[order]))
+        tempos = numpy.concatenate(([500000], tempos[order]))
+        lastOfTick = numpy.append(tempoTicks[1:] != tempoTicks[:-1], True)
+
+        self.segmentTicks = tempoTicks[lastOfTick]
+        self.segmentTempos = tempos[lastOfTick]
+        segmentMicroSeconds = numpy.diff(self.segmentTicks) * self.segmentTempos[:-1] / ticksPerBeat
+        self.segmentStarts = numpy.concatenate(([0], numpy.cumsum(segmentMicroSeconds)))
+
+    def ticksToMicroSeconds(self, ticks):
+        segment = numpy.searchsorted(self.segmentTicks, ticks, side='right') - 1
+        return self.segmentStarts[segment] + (ticks - self.segmentTicks[segment]) * self.segmentTempos[segment] / self.ticksPerBeat
+
+
+# immutable per key entry of VirtualPiano.keyLayout
+# offsetX/width are svg units, left/right are pixels of the video frame
+KeyLayout = namedtuple('KeyLayout', [
+    'noteNumber', 'noteName', 'isWhite', 'drawOrder',
+    'offsetX', 'width', 'left', 'right', 'pathData'
+])
+
 class VirtualPiano(object):
-    def __init__(self, config):
-        self.startNote = config.get('piano', 'startNote', fallback='auto')
-        self.endNote = config.get('piano', 'endNote', fallback='auto')
-        self.colorWhiteKeys = config.get('piano', 'colorWhiteKeys', fallback='#FFFFFF')
-        self.colorBlackKeys = config.get('piano', 'colorBlackKeys', fallback='#131313')
-        self.colorHighlight = config.get('piano', 'colorHighlight', fallback='#DE4439')
-        self.outlineColorWhiteKeys = config.get('piano', 'outlineColorWhiteKeys', fallback='#131313')
-        self.outlineColorBlackKeys = config.get('piano', 'outlineColorBlackKeys', fallback='#131313')
-        self.outlineColorHighlight = config.get('piano', 'outlineColorHighlight', fallback='#6e160f')
+    noteNames = ( "A", "A#", "B", "C", "C#", "D", "D#", "E", "F", "F#", "G", "G#" )
+    blackNoteNames = ( "A#", "C#", "D#", "F#", "G#" )
+
+    # a [keyboard.<name>] section overrides the settings of [piano]
+    def __init__(self, config, section='piano'):
+        def getSetting(key, fallback):
+            return config.get(section, key, fallback=config.get('piano', key, fallback=fallback))
+
+        self.startNote = getSetting('startNote', 'auto')
+        self.endNote = getSetting('endNote', 'auto')
+        self.colorWhiteKeys = getSetting('colorWhiteKeys', '#FFFFFF')
+        self.colorBlackKeys = getSetting('colorBlackKeys', '#131313')
+        self.colorHighlight = getSetting('colorHighlight', '#DE4439')
+        self.outlineColorWhiteKeys = getSetting('outlineColorWhiteKeys', '#131313')
+        self.outlineColorBlackKeys = getSetting('outlineColorBlackKeys', '#131313')
+        self.outlineColorHighlight = getSetting('outlineColorHighlight', '#6e160f')
+        self.velocityLevels = getSetting('velocityLevels', '1')
         self.amountWhiteKeys = 0
         self.pianoWidth = 0
         self.pianoHeight = 0
@@ -51,7 +243,11 @@ class VirtualPiano(object):
         self.tempDir = None
         self.tempDirFrames = None
 
-        self.keySvgPaths = {}
+        # built once by calculateSvgDimensions(). in draw order
+        self.keyLayout = ()
+        # keyLayout entries indexed by noteNumber (None outside of the keyboard range)
+        self.keyLayoutByNote = (None,) * 128
+        self.svgTransform = ""
 
         self.svg = Map({
             'A': Map({ 'L':0, 'M':0, 'R':0 }),
@@ -120,18 +316,57 @@ class VirtualPiano(object):
 
         self.svg.scale.x = self.pianoWidth / realSvgWidth
         self.svg.scale.y = self.pianoHeight / realSvgHeight
+        self.svgTransform = "scale(%s, %s)" % (self.svg.scale.x, self.svg.scale.y)
 
+        self.buildKeyLayout()
+
+    '''
+        the geometry never changes. so calculate everything that is needed
+        per key and per frame only once
+        path coordinates are not pre multiplied with the scale as the svg
+        transform also scales the outline stroke
+    '''
+    def buildKeyLayout(self):
+        keyLayout = []
+        layoutByNote = [None] * 128
+        sumWhiteKeysWidth = 0
+        for drawOrder, noteNumber in enumerate(range(self.startNote, self.endNote+1)):
+            noteName = self.noteNumberToNoteName(noteNumber)
+            isWhite = self.isWhiteKey(noteNumber)
+            if isWhite:
+                offsetX = sumWhiteKeysWidth
+                width = self.svg.white.w
+                sumWhiteKeysWidth += self.svg.white.w
+            else:
+                offsetX = sumWhiteKeysWidth - self.svg.white.w + self.svg[noteName]
+                width = self.svg.black.w
+
+            key = KeyLayout(
+                noteNumber = noteNumber,
+                noteName = noteName,
+                isWhite = isWhite,
+                drawOrder = drawOrder,
+                offsetX = offsetX,
+                width = width,
+                left = offsetX * self.svg.scale.x,
+                right = (offsetX + width) * self.svg.scale.x,
+                pathData = "M%s %s Z" % (offsetX, self.getPathChunkForNoteName(noteName, noteNumber))
+            )
+            keyLayout.append(key)
+            layoutByNote[noteNumber] = key
+
+        self.keyLayout = tuple(keyLayout)
+        self.keyLayoutByNote = tuple(layoutByNote)
 
 
     # thanks to https://stackoverflow.com/questions/712679/convert-midi-note-numbers-to-name-and-octave#answer-54546263
     def noteNumberToNoteName(self, noteNumber):
         noteNumber -= 9
-        notes = [ "A", "A#", "B", "C", "C#", "D", "D#", "E", "F", "F#", "G", "G#" ]
         #octave = math.floor(noteNumber / 12) + 1
-        return notes[ noteNumber % 12 ]
+        return self.noteNames[ noteNumber % 12 ]
 
     def isWhiteKey(self, noteNumber):
-        if self.noteNumberToNoteName(noteNumber) in ["A#", "C#", "D#", "F#", "G#"]:
+        if self.noteNumberToNoteName(noteNumber) in self.blackNoteNames:
             return False
         return True
 
@@ -144,6 +379,9 @@ class VirtualPiano(object):
         return counter
 
     def getLeftOffsetForKeyPlacement(self, noteNumber):
+        if self.keyLayoutByNote[noteNumber]:
+            return self.keyLayoutByNote[noteNumber].offsetX
+
         numWhiteKeys = self.countWhiteKeys(self.startNote, noteNumber)
         sumWhiteKeysWidth = (numWhiteKeys-1) * self.svg.white.w
         if self.isWhiteKey(noteNumber):
@@ -167,6 +405,32 @@ class VirtualPiano(object):
         rgb = list(self.hex2rgb(color))
         return self.adjustColorLightness(rgb[0], rgb[1], rgb[2], 1 - amount)
 
+    # highlight color per velocity level. softer notes are lighter, the loudest level is colorHighlight
+    def getVelocityColors(self):
+        levels = int(self.velocityLevels)
+        return [
+            self.lightenColor(self.colorHighlight, 0.6 * (levels - 1 - level) / (levels - 1)) if level < levels - 1 else self.colorHighlight
+            for level in range(levels)
+        ]
+
+    # fade out color of white keys. softer levels are lighter already, so instead of being
+    # clamped to white they cover the same share of their way to white as the loudest level
+    def getFadeOutColor(self, velocityColor, amount):
+        loudestLightness = self.getLightness(self.colorHighlight)
+        lightness = self.getLightness(velocityColor)
+        if velocityColor == self.colorHighlight or loudestLightness >= 1.0 or lightness <= 0.0:
+            return self.lightenColor(velocityColor, amount)
+        share = (min(loudestLightness * (1 + amount), 1.0) - loudestLightness) / (1 - loudestLightness)
+        return self.lightenColor(velocityColor, (lightness + (1 - lightness) * share) / lightness - 1)
+
+    def getLightness(self, color):
+        r, g, b = self.hex2rgb(color)
+        return rgb_to_hls(r / 255.0, g / 255.0, b / 255.0)[1]
+
+    # levels of equal size over the velocities 1-127
+    def getVelocityLevel(self, velocity):
+        return max(0, velocity - 1) * int(self.velocityLevels) // 127
+
     # thanks to https://news.ycombinator.com/item?id=3583564
     def adjustColorLightness(self, r, g, b, factor):
         h, l, s = rgb_to_hls(r / 255.0, g / 255.0, b / 255.0)
@@ -231,10 +495,6 @@ class VirtualPiano(object):
         )
 
     def getPathChunkForNoteName(self, noteName, noteNumber):
-
-        if str(noteNumber) in self.keySvgPaths:
-            return self.keySvgPaths[str(noteNumber)]
-
         svg = self.svg
         if not self.isWhiteKey(noteNumber):
             pathChunk = self.getSquareShapedPath(svg.black.w, svg.black.h)
@@ -256,16 +516,15 @@ class VirtualPiano(object):
             if noteNumber == self.startNote:
                 pathChunk = self.getSquareShapedPath(svg.white.w, svg.white.h)
 
-        # path does never change. so add it to cache dict
-        self.keySvgPaths[str(noteNumber)] = pathChunk
         return pathChunk
 
 
-    def getSvgPathForNoteNumber(self, noteNumber, offsetX, highlightColor=""):
+    def getSvgPathForNoteNumber(self, noteNumber, highlightColor=""):
+        key = self.keyLayoutByNote[noteNumber]
 
         colorToUse = self.colorBlackKeys
         outlineColor = self.outlineColorBlackKeys
-        if self.isWhiteKey(noteNumber):
+        if key.isWhite:
             colorToUse = self.colorWhiteKeys
             outlineColor = self.outlineColorWhiteKeys
 
@@ -273,15 +532,11 @@ class VirtualPiano(object):
             colorToUse = highlightColor
             outlineColor = self.outlineColorHighlight
 
-        noteLetter = self.noteNumberToNoteName(noteNumber)
-
-        pathString = '<path fill="%s" stroke="%s" d="M%s %s Z"  transform="scale(%s, %s)" />' % (
+        pathString = '<path fill="%s" stroke="%s" d="%s"  transform="%s" />' % (
             colorToUse,
             outlineColor,
-            offsetX,
-            self.getPathChunkForNoteName(noteLetter, noteNumber),
-            self.svg.scale.x,
-            self.svg.scale.y
+            key.pathData,
+            self.svgTransform
         )
 
         return pathString
@@ -290,302 +545,2212 @@ class VirtualPiano(object):
 
 
 
+class KeySpriteCompositor(object):
+    '''
+        the keyboard geometry never changes. so instead of rasterizing a whole svg
+        document for each frame every key gets rasterized only once per color.
+        the result is kept as cropped bitmap sprite (premultiplied rgba) and frames
+        are composed by blending those sprites into a numpy buffer in the very same
+        order the svg engine draws its paths.
+        the buffer of the previous frame is kept. a new frame repaints only the pixel
+        columns of keys with a different color than before
+    '''
+    def __init__(self, piano, width, height):
+        self.piano = piano
+        self.width = width
+        self.height = height
+        self.sprites = {}
+        # premultiplied buffer, rgba result and key colors of the previously composed frame
+        self.frame = None
+        self.rgba = None
+        self.frameNotes = {}
+
+    def getSprite(self, noteNumber, highlightColor=""):
+        spriteKey = (noteNumber, highlightColor)
+        if spriteKey in self.sprites:
+            return self.sprites[spriteKey]
+
+        svgString = '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 %d %d">%s</svg>' % (
+            self.width,
+            self.height,
+            self.piano.getSvgPathForNoteNumber(noteNumber, highlightColor)
+        )
+        pixels = numpy.asarray(
+            Image.open(io.BytesIO(svg2png(bytestring=svgString))).convert('RGBA'),
+            dtype=numpy.float32
+        ) / 255
+
+        sprite = None
+        rows = numpy.flatnonzero(pixels[:, :, 3].any(axis=1))
+        cols = numpy.flatnonzero(pixels[:, :, 3].any(axis=0))
+        if rows.size > 0:
+            # crop to the bounding box of the key. copy so the full frame sized
+            # raster is freed instead of being kept alive by the view
+            pixels = pixels[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1].copy()
+            pixels[:, :, :3] *= pixels[:, :, 3:]
+            sprite = Map({
+                'y': slice(rows[0], rows[-1]+1),
+                'x': slice(cols[0], cols[-1]+1),
+                'pixels': pixels
+            })
+
+        self.sprites[spriteKey] = sprite
+        return sprite
+
+    # returns a rgba uint8 array of the frame
+    def composeFrame(self, highlightedNotes):
+        if self.frame is None:
+            self.frame = numpy.zeros((self.height, self.width, 4), dtype=numpy.float32)
+            self.rgba = numpy.zeros((self.height, self.width, 4), dtype=numpy.uint8)
+            dirtySpans = [[0, self.width]]
+        else:
+            dirtySpans = self.getDirtySpans(highlightedNotes)
+
+        self.frameNotes = dict(highlightedNotes)
+        for left, right in dirtySpans:
+            self.repaintSpan(left, right)
+
+        return self.rgba.copy()
+
+    # merged pixel column ranges of all keys that change their color
+    def getDirtySpans(self, highlightedNotes):
+        spans = []
+        for noteNumber in set(self.frameNotes) | set(highlightedNotes):
+            previousColor = self.frameNotes.get(noteNumber, "")
+            color = highlightedNotes.get(noteNumber, "")
+            if previousColor == color or not self.piano.keyLayoutByNote[noteNumber]:
+                continue
+            for sprite in (self.getSprite(noteNumber, previousColor), self.getSprite(noteNumber, color)):
+                if sprite:
+                    spans.append((sprite.x.start, sprite.x.stop))
+
+        dirtySpans = []
+        for left, right in sorted(spans):
+            if dirtySpans and left <= dirtySpans[-1][1]:
+                dirtySpans[-1][1] = max(dirtySpans[-1][1], right)
+            else:
+                dirtySpans.append([left, right])
+        return dirtySpans
+
+    # blends all keys that overlap the columns (black keys cover their white neighbours)
+    def repaintSpan(self, left, right):
+        self.frame[:, left:right] = 0
+        for key in self.piano.keyLayout:
+            sprite = self.getSprite(key.noteNumber, self.frameNotes.get(key.noteNumber, ""))
+            if sprite is None or sprite.x.stop <= left or sprite.x.start >= right:
+                continue
+            spriteLeft = max(left, sprite.x.start)
+            spriteRight = min(right, sprite.x.stop)
+            pixels = sprite.pixels[:, spriteLeft - sprite.x.start:spriteRight - sprite.x.start]
+            # porter duff "over" just like cairo draws one path after another
+            region = self.frame[sprite.y, spriteLeft:spriteRight]
+            region *= 1 - pixels[:, :, 3:]
+            region += pixels
+
+        self.rgba[:, left:right] = self.unpremultiply(self.frame[:, left:right])
+
+    def unpremultiply(self, frame):
+        alpha = frame[:, :, 3:]
+        rgb = numpy.divide(frame[:, :, :3], alpha, out=numpy.zeros_like(frame[:, :, :3]), where=alpha > 0)
+        rgba = numpy.empty(frame.shape, dtype=numpy.uint8)
+        rgba[:, :, :3] = numpy.rint(numpy.clip(rgb, 0, 1) * 255)
+        rgba[:, :, 3:] = numpy.rint(numpy.clip(alpha, 0, 1) * 255)
+        return rgba
+
+
+class FrameCache(object):
+    '''
+        persistent content addressed storage of rendered png frames. shared by all
+        runs and midi files. the filename is a fixed length digest of the render
+        configuration and the key state. the least recently used frames get removed
+        as soon as the cache grows beyond its maximum size. each run pins the cache
+        while it uses it and frames only get removed when no other run holds a pin
+    '''
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.bytesWritten = 0
+        self.pinPath = None
+
+    # marks the cache as in use by this run. the pid in the name identifies stale pins
+    def pin(self):
+        pinDir = Path('%s/pins' % self.directory.resolve())
+        pinDir.mkdir(parents=True, exist_ok=True)
+        self.pinPath = Path('%s/%i-%i.pin' % (pinDir, os.getpid(), id(self)))
+        self.pinPath.touch()
+
+    def unpin(self):
+        if self.pinPath:
+            self.pinPath.unlink(missing_ok=True)
+            self.pinPath = None
+
+    # pins of other processes. the ones of processes that do not exist anymore get removed
+    # runs of this process are sequential, so its own pins never count
+    def getForeignPins(self):
+        foreignPins = []
+        for pinPath in Path('%s/pins' % self.directory.resolve()).glob('*.pin'):
+            pid = pinPath.stem.split('-')[0]
+            if pid == str(os.getpid()):
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                pinPath.unlink(missing_ok=True)
+                continue
+            except (ValueError, PermissionError):
+                pass
+            foreignPins.append(pinPath)
+        return foreignPins
+
+    def getPath(self, frameDigest):
+        # spread files over subdirectories to avoid filesystem boundries
+        return Path('%s/%s/%s.png' % (self.directory.resolve(), frameDigest[:2], frameDigest))
+
+    # returns True if the frame exists. marks it as recently used
+    def contains(self, frameDigest):
+        framePath = self.getPath(frameDigest)
+        try:
+            os.utime(framePath)
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def read(self, frameDigest):
+        if not self.contains(frameDigest):
+            return None
+        try:
+            return self.getPath(frameDigest).read_bytes()
+        except FileNotFoundError:
+            # removed by a concurrent run
+            return None
+
+    def write(self, frameDigest, frameData):
+        framePath = self.getPath(frameDigest)
+        framePath.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary name first. concurrent runs must never see incomplete frames
+        tempPath = Path('%s.%i.tmp' % (framePath, os.getpid()))
+        tempPath.write_bytes(frameData)
+        os.replace(tempPath, framePath)
+        self.bytesWritten += len(frameData)
+
+    # remove least recently used frames. frames that have been used since keepSince are never removed
+    # nothing gets removed while other runs use the cache as they may still need any of the frames
+    def evict(self, keepSince=0):
+        if self.getForeignPins():
+            logging.info("frame cache is in use by other runs. skipped removing frames")
+            return
+
+        cachedFrames = []
+        totalBytes = 0
+        for framePath in self.directory.glob('*/*.png'):
+            try:
+                stat = framePath.stat()
+            except FileNotFoundError:
+                continue
+            cachedFrames.append((stat.st_mtime, stat.st_size, framePath))
+            totalBytes += stat.st_size
+
+        if totalBytes <= self.maxBytes:
+            return
+
+        removedFrames = 0
+        for mtime, size, framePath in sorted(cachedFrames, key=lambda cachedFrame: cachedFrame[0]):
+            if totalBytes <= self.maxBytes or mtime >= keepSince:
+                break
+            try:
+                framePath.unlink()
+            except FileNotFoundError:
+                pass
+            totalBytes -= size
+            removedFrames += 1
+
+        logging.info("removed %i frames from frame cache (%i MB left)" % (removedFrames, totalBytes / 1024 / 1024))
+
+
+# KeySpriteCompositor per render configuration digest. limited to the most recently used ones
+sharedKeySpriteCompositors = OrderedDict()
+
+class FrameRenderer(object):
+    '''
+        renders a single frame for a dict of highlighted notes (noteNumber: color)
+        it is independent from the timeline so it can be sent to worker processes
+    '''
+    def __init__(self, piano, width, height, renderEngine, renderConfigDigest=None):
+        self.piano = piano
+        self.width = width
+        self.height = height
+        self.renderEngine = renderEngine
+        self.renderConfigDigest = renderConfigDigest
+        self.compositor = None
+
+    def getSvgPathsForFrame(self, highlightedNotes):
+        pathStrings = []
+        for key in self.piano.keyLayout:
+            highlightColor = ""
+            if key.noteNumber in highlightedNotes:
+                highlightColor = highlightedNotes[key.noteNumber]
+            pathStrings.append( self.piano.getSvgPathForNoteNumber(key.noteNumber, highlightColor) )
+        return '\n'.join(pathStrings)
+
+    def getSvgStringForFrame(self, highlightedNotes):
+        return '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 %d %d">%s</svg>' % (
+            self.width,
+            self.height,
+            self.getSvgPathsForFrame(highlightedNotes)
+        )
+
+    # sprites are shared with all renderers of this process that use the same configuration
+    def getCompositor(self):
+        if self.compositor:
+            return self.compositor
+
+        if self.renderConfigDigest in sharedKeySpriteCompositors:
+            sharedKeySpriteCompositors.move_to_end(self.renderConfigDigest)
+            self.compositor = sharedKeySpriteCompositors[self.renderConfigDigest]
+            return self.compositor
+
+        self.compositor = KeySpriteCompositor(self.piano, self.width, self.height)
+        if self.renderConfigDigest:
+            sharedKeySpriteCompositors[self.renderConfigDigest] = self.compositor
+            while len(sharedKeySpriteCompositors) > 8:
+                sharedKeySpriteCompositors.popitem(last=False)
+        return self.compositor
+
+    # returns png bytes or raw rgba bytes (sprite engine only)
+    def renderFrame(self, highlightedNotes, rawOutput=False):
+        if self.renderEngine != 'sprite':
+            return svg2png( bytestring=self.getSvgStringForFrame(highlightedNotes) )
+
+        frame = self.getCompositor().composeFrame(highlightedNotes)
+        if rawOutput:
+            return frame.tobytes()
+
+        pngBytes = io.BytesIO()
+        Image.fromarray(frame).save(pngBytes, format='PNG')
+        return pngBytes.getvalue()
+
+
+class KeyboardStackRenderer(object):
+    '''
+        renders several keyboards stacked from top to bottom into a single frame.
+        the highlighted notes are slots (keyboard index * 128 + note number). every
+        keyboard has its own FrameRenderer so keyboards with the same configuration
+        share their sprites
+    '''
+    def __init__(self, frameRenderers, width, height, renderEngine):
+        self.frameRenderers = frameRenderers
+        self.width = width
+        self.height = height
+        self.renderEngine = renderEngine
+
+    def getKeyboardNotes(self, highlightedNotes):
+        keyboardNotes = [ {} for frameRenderer in self.frameRenderers ]
+        for slot, color in highlightedNotes.items():
+            keyboardNotes[slot >> 7][slot & 127] = color
+        return keyboardNotes
+
+    def getSvgStringForFrame(self, highlightedNotes):
+        groups = []
+        top = 0
+        for frameRenderer, notes in zip(self.frameRenderers, self.getKeyboardNotes(highlightedNotes)):
+            groups.append('<g transform="translate(0, %d)">%s</g>' % (top, frameRenderer.getSvgPathsForFrame(notes)))
+            top += frameRenderer.height
+
+        return '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 %d %d">%s</svg>' % (
+            self.width,
+            self.height,
+            '\n'.join(groups)
+        )
+
+    # returns png bytes or raw rgba bytes (sprite engine only)
+    def renderFrame(self, highlightedNotes, rawOutput=False):
+        if self.renderEngine != 'sprite':
+            return svg2png( bytestring=self.getSvgStringForFrame(highlightedNotes) )
+
+        frame = numpy.concatenate([
+            frameRenderer.getCompositor().composeFrame(notes)
+            for frameRenderer, notes in zip(self.frameRenderers, self.getKeyboardNotes(highlightedNotes))
+        ])
+        if rawOutput:
+            return frame.tobytes()
+
+        pngBytes = io.BytesIO()
+        Image.fromarray(frame).save(pngBytes, format='PNG')
+        return pngBytes.getvalue()
+
+
+class PianoRollRenderer(object):
+    '''
+        falling notes above the keyboard. the rows of the roll are a time axis with the
+        time of the frame at the bottom. the rows are kept in a ring buffer, so the next
+        frame only draws the rows that scroll in at the top. the cost per frame depends
+        on the scroll distance and not on the amount of visible notes.
+        notes use the horizontal key positions of the VirtualPiano
+    '''
+    def __init__(self, piano, timeline, width, height, visibleSeconds, framesPerSecond, backgroundColor, lineColor):
+        self.width = width
+        self.height = height
+        self.framesPerSecond = framesPerSecond
+        self.rowsPerSecond = height / visibleSeconds
+
+        # first and last (exclusive) row of each note. in timeline order so the first rows are sorted
+        self.noteStartRows = numpy.floor(timeline.onTime / 1000000 * self.rowsPerSecond).astype(numpy.int64)
+        noteEndRows = numpy.full(timeline.length, numpy.iinfo(numpy.int64).max, dtype=numpy.int64)
+        released = numpy.isfinite(timeline.offTime)
+        noteEndRows[released] = numpy.floor(timeline.offTime[released] / 1000000 * self.rowsPerSecond)
+        # an empty row separates repeated notes of the same key
+        self.noteEndRows = numpy.maximum(noteEndRows - 1, self.noteStartRows + 1)
+        self.noteNumbers = timeline.note
+        velocityLevels = numpy.array([ piano.getVelocityLevel(velocity) for velocity in range(128) ], dtype=numpy.uint8)
+        self.noteLevels = velocityLevels[timeline.velocity]
+
+        # (isBlack, left, right, fill color per velocity level, outline color) per note number
+        self.noteShapes = [None] * 128
+        for key in piano.keyLayout:
+            fillColors = tuple(
+                piano.hex2rgb(velocityColor if key.isWhite else piano.darkenColor(velocityColor, 0.2)) + (255,)
+                for velocityColor in piano.getVelocityColors()
+            )
+            self.noteShapes[key.noteNumber] = (
+                not key.isWhite,
+                int(round(key.left)),
+                int(round(key.right)),
+                fillColors,
+                piano.hex2rgb(piano.outlineColorHighlight) + (255,)
+            )
+
+        noteIsBlack = numpy.array([ bool(noteShape and noteShape[0]) for noteShape in self.noteShapes ])
+        self.noteIsBlack = noteIsBlack[self.noteNumbers]
+
+        self.backgroundRow = numpy.empty((width, 4), dtype=numpy.uint8)
+        self.backgroundRow[:] = piano.hex2rgb(backgroundColor) + (255,)
+        if lineColor:
+            # a guide line at the left edge of each C
+            for key in piano.keyLayout:
+                if key.noteName == 'C' and 0 < round(key.left) < width:
+                    self.backgroundRow[int(round(key.left))] = piano.hex2rgb(lineColor) + (255,)
+
+        # global row n is at ring index -n % height. so the ring holds the rows from top to bottom
+        self.ring = numpy.empty((height, width, 4), dtype=numpy.uint8)
+        self.frame = None
+        self.topRow = None
+        self.frameNumber = None
+        # timeline index of the next note that has not been visible yet and the visible notes
+        # on white and on black keys. both stay in timeline order as notes only get appended
+        self.noteCursor = 0
+        self.activeWhiteNotes = []
+        self.activeBlackNotes = []
+        self.rowsDrawn = 0
+        self.redraws = 0
+
+    # returns the raw rgba frame of the roll above the given keyboard frame. valid until the next call
+    def composeFrame(self, frameNumber, keyboardFrame):
+        keyboardRows = numpy.frombuffer(keyboardFrame, dtype=numpy.uint8).reshape(-1, self.width, 4)
+        if self.frame is None:
+            self.frame = numpy.empty((self.height + len(keyboardRows), self.width, 4), dtype=numpy.uint8)
+
+        self.scrollTo(frameNumber)
+        ringStart = -self.topRow % self.height
+        self.frame[:self.height - ringStart] = self.ring[ringStart:]
+        self.frame[self.height - ringStart:self.height] = self.ring[:ringStart]
+        self.frame[self.height:] = keyboardRows
+        return self.frame.reshape(-1).data
+
+    def scrollTo(self, frameNumber):
+        bottomRow = int(frameNumber * self.rowsPerSecond / self.framesPerSecond)
+        topRow = bottomRow + self.height - 1
+        if self.topRow is None or frameNumber != self.frameNumber + 1 or topRow - self.topRow >= self.height:
+            # first frame, seek or a jump by more than the height of the roll
+            self.drawRows(bottomRow, topRow + 1, seek=True)
+            self.redraws += 1
+        elif topRow > self.topRow:
+            self.drawRows(self.topRow + 1, topRow + 1)
+        self.topRow = topRow
+        self.frameNumber = frameNumber
+
+    # draws the global rows firstRow to endRow (exclusive) into the ring
+    def drawRows(self, firstRow, endRow, seek=False):
+        noteCursor = int(numpy.searchsorted(self.noteStartRows, endRow))
+        if seek:
+            activeNotes = numpy.flatnonzero(self.noteEndRows[:noteCursor] > firstRow)
+            self.activeWhiteNotes = activeNotes[~self.noteIsBlack[activeNotes]].tolist()
+            self.activeBlackNotes = activeNotes[self.noteIsBlack[activeNotes]].tolist()
+        else:
+            noteEndRows = self.noteEndRows
+            self.activeWhiteNotes = [ noteIndex for noteIndex in self.activeWhiteNotes if noteEndRows[noteIndex] > firstRow ]
+            self.activeBlackNotes = [ noteIndex for noteIndex in self.activeBlackNotes if noteEndRows[noteIndex] > firstRow ]
+            for noteIndex in range(self.noteCursor, noteCursor):
+                if self.noteIsBlack[noteIndex]:
+                    self.activeBlackNotes.append(noteIndex)
+                else:
+                    self.activeWhiteNotes.append(noteIndex)
+        self.noteCursor = noteCursor
+
+        # rows in time order. the first row is the bottom one
+        rows = numpy.empty((endRow - firstRow, self.width, 4), dtype=numpy.uint8)
+        rows[:] = self.backgroundRow
+        # white keys first. the narrower black keys cover them
+        for noteIndex in self.activeWhiteNotes + self.activeBlackNotes:
+            isBlack, left, right, fillColors, outlineColor = self.noteShapes[self.noteNumbers[noteIndex]]
+            fillColor = fillColors[self.noteLevels[noteIndex]]
+            startRow = int(self.noteStartRows[noteIndex])
+            endRowOfNote = int(self.noteEndRows[noteIndex])
+            top = max(startRow, firstRow) - firstRow
+            bottom = min(endRowOfNote, endRow) - firstRow
+            rows[top:bottom, left:right] = outlineColor
+            rows[top:bottom, left+1:right-1] = fillColor
+            if startRow >= firstRow:
+                rows[startRow - firstRow, left:right] = outlineColor
+            if endRowOfNote <= endRow:
+                rows[endRowOfNote - 1 - firstRow, left:right] = outlineColor
+
+        # reversed into the ring. the last row is the top one
+        ringStart = -(endRow - 1) % self.height
+        rowCount = len(rows)
+        firstPart = min(rowCount, self.height - ringStart)
+        self.ring[ringStart:ringStart + firstPart] = rows[::-1][:firstPart]
+        self.ring[:rowCount - firstPart] = rows[::-1][firstPart:]
+        self.rowsDrawn += rowCount
+
+
+# each worker process of the render pool holds its own FrameRenderer (and sprites)
+workerFrameRenderer = None
+
+def initFrameRenderWorker(frameRenderer):
+    global workerFrameRenderer
+    workerFrameRenderer = frameRenderer
+
+# returns the frame data and the time spent for rasterizing it
+def renderFrameInWorker(frameStateDescriptor):
+    highlightedNotes, rawOutput = frameStateDescriptor
+    startTime = time.time()
+    frameData = workerFrameRenderer.renderFrame(dict(highlightedNotes), rawOutput)
+    return frameData, time.time() - startTime
+
+
+class RunStats(object):
+    '''
+        timings and counters of a single run. phases are cumulative seconds,
+        commands are the external processes (ffmpeg, fluidsynth)
+    '''
+    def __init__(self):
+        self.startTime = time.time()
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self.commands = []
+
+    @contextmanager
+    def measure(self, phase):
+        startTime = time.time()
+        try:
+            yield
+        finally:
+            self.addTime(phase, time.time() - startTime)
+
+    def addTime(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def count(self, counter, amount=1):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def addCommand(self, description, seconds, returnCode):
+        self.commands.append({ 'description': description, 'seconds': seconds, 'returnCode': returnCode })
+
+    def getReport(self):
+        return {
+            'seconds': time.time() - self.startTime,
+            'phases': dict(self.phases),
+            'counters': dict(self.counters),
+            'commands': self.commands
+        }
+
+
+class RawMidiParser(object):
+    '''
+        incremental parser of raw midi bytes as sent by devices. returns the note
+        events of each chunk as (noteNumber, velocity, channel). velocity 0 is a note off
+    '''
+    def __init__(self):
+        self.runningStatus = 0
+        self.data = []
+        self.inSysex = False
+
+    def feed(self, chunk):
+        noteEvents = []
+        for byte in chunk:
+            if byte >= 0xF8:
+                # realtime messages (clock, active sensing) may appear anywhere
+                continue
+
+            if byte >= 0x80:
+                self.inSysex = byte == 0xF0
+                # system messages cancel the running status
+                self.runningStatus = byte if byte < 0xF0 else 0
+                self.data = []
+                continue
+
+            if self.inSysex or not self.runningStatus:
+                continue
+
+            self.data.append(byte)
+            messageType = self.runningStatus & 0xF0
+            if len(self.data) < MidiFileReader.channelDataLength[messageType]:
+                continue
+
+            channel = self.runningStatus & 0x0F
+            if messageType == 0x90:
+                noteEvents.append((self.data[0], self.data[1], channel))
+            elif messageType == 0x80:
+                noteEvents.append((self.data[0], 0, channel))
+            self.data = []
+
+        return noteEvents
+
+
+class LiveFrameRenderer(threading.Thread):
+    '''
+        renders the most recently submitted key state in the background. states that
+        get submitted while a frame is rendered replace each other, so the frame clock
+        never waits for rendering. it always takes the last finished frame instead
+    '''
+    def __init__(self, frameRenderer, rawOutput):
+        super().__init__(daemon=True)
+        self.frameRenderer = frameRenderer
+        self.rawOutput = rawOutput
+        self.condition = threading.Condition()
+        self.pendingState = None
+        self.pendingEventTimes = []
+        self.frameData = None
+        self.frameEventTimes = []
+        self.busy = False
+        self.stopped = False
+        self.supersededStates = 0
+        self.renderSeconds = 0
+
+    # highlightedNotes and the receive times of the note events that lead to this state
+    def submit(self, highlightedNotes, eventTimes):
+        with self.condition:
+            if self.pendingState is not None:
+                self.supersededStates += 1
+            self.pendingState = highlightedNotes
+            self.pendingEventTimes += eventTimes
+            self.condition.notify()
+
+    # returns the last finished frame and the event times that are shown for the first time
+    def takeFrame(self):
+        with self.condition:
+            eventTimes = self.frameEventTimes
+            self.frameEventTimes = []
+            return self.frameData, eventTimes
+
+    def isIdle(self):
+        with self.condition:
+            return self.pendingState is None and not self.busy
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pendingState is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                highlightedNotes = self.pendingState
+                eventTimes = self.pendingEventTimes
+                self.pendingState = None
+                self.pendingEventTimes = []
+                self.busy = True
+
+            startTime = time.time()
+            frameData = self.frameRenderer.renderFrame(dict(highlightedNotes), self.rawOutput)
+            if not self.rawOutput:
+                # the svg engine renders png
+                frameData = Image.open(io.BytesIO(frameData)).convert('RGBA').tobytes()
+
+            with self.condition:
+                self.renderSeconds += time.time() - startTime
+                self.frameData = frameData
+                self.frameEventTimes += eventTimes
+                self.busy = False
+
+
+'''
+    named encoder settings for [encoder] profile. keyframeInterval is in seconds
+    (0 = every frame is a keyframe, empty = encoder default). muxerArgs are only
+    applied to the final output file
+'''
+ENCODER_PROFILES = {
+    # the settings of earlier versions. ffmpeg defaults for h264
+    'default': Map({
+        'codec': 'libx264', 'preset': '', 'crf': '', 'bitrate': '', 'keyframeInterval': '', 'tune': '',
+        'pixelFormat': 'yuv420p', 'codecArgs': [], 'muxerArgs': [], 'container': 'mp4', 'audioCodec': 'aac'
+    }),
+    # quick encode for checking the result
+    'draft': Map({
+        'codec': 'libx264', 'preset': 'ultrafast', 'crf': '30', 'bitrate': '', 'keyframeInterval': '10', 'tune': '',
+        'pixelFormat': 'yuv420p', 'codecArgs': [], 'muxerArgs': [], 'container': 'mp4', 'audioCodec': 'aac'
+    }),
+    # flat colors with sharp edges. animation tuning and full chroma resolution
+    'archival': Map({
+        'codec': 'libx264', 'preset': 'veryslow', 'crf': '12', 'bitrate': '', 'keyframeInterval': '10', 'tune': 'animation',
+        'pixelFormat': 'yuv444p', 'codecArgs': [], 'muxerArgs': [], 'container': 'mkv', 'audioCodec': 'flac'
+    }),
+    # intra-only for video editors. every frame can be decoded on its own
+    'intra': Map({
+        'codec': 'prores_ks', 'preset': '', 'crf': '', 'bitrate': '', 'keyframeInterval': '', 'tune': '',
+        'pixelFormat': 'yuv422p10le', 'codecArgs': ['-profile:v', '3'], 'muxerArgs': [], 'container': 'mov', 'audioCodec': 'pcm_s16le'
+    }),
+    # small files that start playing before they are completely downloaded
+    'web': Map({
+        'codec': 'libx264', 'preset': 'slow', 'crf': '24', 'bitrate': '', 'keyframeInterval': '2', 'tune': 'animation',
+        'pixelFormat': 'yuv420p', 'codecArgs': ['-profile:v', 'high'], 'muxerArgs': ['-movflags', '+faststart'],
+        'container': 'mp4', 'audioCodec': 'aac'
+    }),
+    # lossless intermediates for further editing
+    'lossless': Map({
+        'codec': 'ffv1', 'preset': '', 'crf': '', 'bitrate': '', 'keyframeInterval': '0', 'tune': '',
+        'pixelFormat': 'bgr0', 'codecArgs': ['-level', '3'], 'muxerArgs': [], 'container': 'mkv', 'audioCodec': 'flac'
+    }),
+    'png': Map({
+        'codec': 'png', 'preset': '', 'crf': '', 'bitrate': '', 'keyframeInterval': '', 'tune': '',
+        'pixelFormat': 'rgb24', 'codecArgs': [], 'muxerArgs': [], 'container': 'mkv', 'audioCodec': 'flac'
+    })
+}
+
 class Midi2Video(object):
     def __init__(self, scriptPath, config):
         self.scriptPath = scriptPath
+        # videos, reports and temp files. a directory per job in daemon mode
+        self.outputDir = scriptPath
         self.midiFile = None
         self.midiFileCopy = None
-        self.notesToProcess = []
-        self.openNotes = {}
-        self.noteFadeIns = {}
-        self.noteFadeOuts = {}
-        self.piano = VirtualPiano(config)
-        self.lowestFoundNoteNumber = 200
-        self.highestFoundNoteNumber = 0
+        self.timeline = None
+        self.timelineOnCursor = 0
+        self.timelineOffCursor = 0
+        # keyboards stacked from top to bottom. the [keyboard.<name>] sections in the order
+        # of the config or the single keyboard of [piano]
+        self.keyboards = []
+        keyboardSections = [ section for section in config.sections() if section.startswith('keyboard.') ]
+        for section in keyboardSections or ['piano']:
+            channels = config.get(section, 'channels', fallback=config.get('piano', 'channels', fallback=''))
+            tracks = config.get(section, 'tracks', fallback=config.get('piano', 'tracks', fallback=''))
+            self.keyboards.append(Map({
+                'section': section,
+                'piano': VirtualPiano(config, section),
+                # 0-based channel and track numbers of the shown notes. empty = all. None = invalid setting
+                'channelsSetting': channels,
+                'channels': self.parseNumberList(channels, 16),
+                'tracksSetting': tracks,
+                'tracks': self.parseNumberList(tracks, 65536),
+                'lowestFoundNoteNumber': 200,
+                'highestFoundNoteNumber': 0,
+                'height': 0,
+                'frameRenderer': None
+            }))
+        self.piano = self.keyboards[0].piano
+        # notes of all keyboards are slots: keyboard index * 128 + note number
+        slotCount = 128 * len(self.keyboards)
+        # key state as bitsets over the slots (bit n = slot n)
+        self.pressedKeys = 0
+        self.fadingKeys = 0
+        # fade step per slot. 0 = not fading
+        self.noteFadeIns = [0] * slotCount
+        self.noteFadeOuts = [0] * slotCount
+        # velocity level per slot of the last pressed note
+        self.noteLevels = [0] * slotCount
+        # all highlight colors. frame states refer to them by index
+        self.highlightPalette = None
+        # per slot and velocity level: palette index of the highlight color and
+        # palette index per fade step (index 0 is unused) of the fade schedules
+        self.slotHighlights = ()
+        self.slotFadeInSchedules = ()
+        self.slotFadeOutSchedules = ()
+        # velocity level of each velocity per slot
+        self.slotVelocityLevels = ()
         self.notesCollected = False
         self.videoWidth = int(config.get('video', 'width', fallback=800))
         self.videoHeight = int(config.get('video', 'height', fallback=100))
         self.framesPerSecond = int(config.get('video', 'frameRate', fallback=25))
         self.soundFont = config.get('video', 'soundFont', fallback='')
+        self.addAudio = config.get('video', 'addAudio', fallback='0')
+        self.audioSynthesis = None
         self.noteFadeIn = config.get('video', 'noteFadeIn', fallback='0')
         self.noteFadeOut = config.get('video', 'noteFadeOut', fallback='0')
         self.fixTrackLength = config.get('preprocess', 'fixTrackLength', fallback='0')
+        self.streamFrames = config.get('video', 'streamFrames', fallback='1')
+        self.renderEngine = config.get('video', 'renderEngine', fallback='sprite')
+        self.workers = config.get('video', 'workers', fallback='auto')
+        self.holdFrames = config.get('video', 'holdFrames', fallback='1')
+        self.variableFrameRate = config.get('video', 'variableFrameRate', fallback='0')
+        self.encodeSegments = config.get('video', 'encodeSegments', fallback='1')
+        self.encodeThreads = config.get('video', 'encodeThreads', fallback='auto')
+        self.encoderProfile = config.get('encoder', 'profile', fallback='default')
+        # settings of the profile with the single values of [encoder] applied
+        self.encoder = Map(ENCODER_PROFILES.get(self.encoderProfile, ENCODER_PROFILES['default']))
+        for setting in ['codec', 'preset', 'crf', 'bitrate', 'keyframeInterval', 'tune', 'pixelFormat', 'container', 'audioCodec']:
+            value = config.get('encoder', setting, fallback='')
+            if value:
+                self.encoder[setting] = value
+        # several sizes from a single render as (name, "WIDTHxHEIGHT [profile]")
+        self.outputSpecs = config.items('outputs') if config.has_section('outputs') else []
+        # name, width, height, encoder and path of each video. resolved by resolveOutputs()
+        self.outputs = []
+        self.frameCacheDir = config.get('cache', 'frameCacheDir', fallback='')
+        self.frameCacheMaxSize = int(config.get('cache', 'frameCacheMaxSize', fallback=2048))
+        self.frameCache = None
+        self.renderConfigDigest = None
+        self.runStartTime = time.time()
+        self.frameRenderer = None
+        self.stats = RunStats()
+        self.runReport = config.get('report', 'runReport', fallback='1')
+        self.reportFile = None
+        self.profileFile = None
+        # of the running phase for the job status of the daemon
+        self.progress = Map({ 'phase': '', 'percent': 0 })
+
+        # unique key states (frameDigest, highlighted notes) in order of first appearance
+        self.frameStates = []
+        # index of self.frameStates for each frame
+        self.frameStateIndexes = None
+
+        # identical frames are reused from memory when streaming. limit the amount of
+        # memory as raw frames of big resolutions are huge
+        self.streamedFrames = OrderedDict()
+        self.streamedFramesBytes = 0
+        self.streamedFramesMaxBytes = 256 * 1024 * 1024
 
         self.videoDurationMs = 0
         self.videoTotalFrames = 0
+        self.tempoMap = None
+        # (tick, numerator, denominator power of two)
+        self.timeSignatures = []
+
+        # optional excerpt (--start/--end) as time or bar:N. resolved to 1-based frame numbers
+        self.rangeStart = None
+        self.rangeEnd = None
+        self.firstFrame = 1
+        self.lastFrame = 0
+        # None, 'video', 'still' or 'sheet'
+        self.preview = None
+        self.previewSheetColumns = int(config.get('preview', 'sheetColumns', fallback=4))
+        self.previewSheetFrames = int(config.get('preview', 'sheetFrames', fallback=24))
+
+        # live mode (--live). liveStream is set for sources without a midi file to analyze
+        self.liveSource = None
+        self.liveStream = False
+        self.liveOutput = config.get('live', 'output', fallback='live.mp4')
+        self.liveOutputFormat = config.get('live', 'outputFormat', fallback='')
+
+        # falling notes above the keyboard. pianoRollRows is resolved by validateConfig
+        self.pianoRoll = config.get('pianoRoll', 'enabled', fallback='0')
+        self.pianoRollHeight = config.get('pianoRoll', 'height', fallback='75')
+        self.pianoRollSeconds = config.get('pianoRoll', 'seconds', fallback='3')
+        self.pianoRollBackgroundColor = config.get('pianoRoll', 'backgroundColor', fallback='#1B1B1B')
+        self.pianoRollLineColor = config.get('pianoRoll', 'lineColor', fallback='#2E2E2E')
+        self.pianoRollRows = 0
+        self.pianoRollRenderer = None
 
         self.tempDir = None
         self.tempDirFrames = None
 
+    # comma separated 1-based numbers like the channel numbers of sequencers
+    def parseNumberList(self, value, maxNumber):
+        try:
+            numbers = frozenset( int(number) - 1 for number in value.replace(',', ' ').split() )
+        except ValueError:
+            return None
+        if any(number < 0 or number >= maxNumber for number in numbers):
+            return None
+        return numbers
+
     # we need to add an absolute microtimestamp to each note event
-    # TODO: add configuration like channelWhitelist and/or channelBlacklist
     def prepareNoteEvents(self):
-        if self.midiFileCopy:
-            pattern = midi.FileIO.read_midifile(self.midiFileCopy.resolve())
-        else:
-            pattern = midi.FileIO.read_midifile(self.midiFile.resolve())
-
-        tempo = 50000        # default: 120 BPM
-        ticksPerBeat = pattern.resolution
-        lastEventTick = 0
-        microseconds = 0
-
-        mpt = tempo / ticksPerBeat
-
-        # https://stackoverflow.com/questions/34166367/how-to-correctly-convert-midi-ticks-to-milliseconds#answer-34174936
-        for track in pattern:
-            t = 0
-            #track.make_ticks_abs()
-            for event in track:
-
-                if event.__class__.__name__ == "SetTempoEvent":
-                    tempo = event.mpqn
-                    mpt = tempo / ticksPerBeat
-
-                deltaTicks = event.tick - lastEventTick
-                lastEventTick = event.tick
-                deltaMicroseconds = tempo * deltaTicks / ticksPerBeat
-                microseconds += deltaMicroseconds
-                t += event.tick
-                if event.__class__.__name__ not in ["NoteOnEvent", "NoteOffEvent"]:
-                    continue
+        parseStartTime = time.time()
+        midiFileReader = MidiFileReader(self.midiFile.resolve(), self.fixTrackLength == '1')
+
+        tempoTicks = []
+        tempos = []
+        self.timeSignatures = []
+        maxNoteTick = 0
+        # typed arrays instead of lists keep long sessions at a few bytes per event
+        eventTicks = array.array('q')
+        eventNotes = array.array('B')
+        eventVelocities = array.array('B')
+        eventChannels = array.array('B')
+        eventTracks = array.array('H')
+
+        for trackNumber, tick, eventType, noteNumber, velocity, channel in midiFileReader.readEvents():
+            if eventType == MidiFileReader.SET_TEMPO:
+                # tempo events of all tracks apply to all tracks
+                tempoTicks.append(tick)
+                tempos.append(noteNumber)
+                continue
 
-                eventMicroSecond = t * mpt
-                if eventMicroSecond > self.videoDurationMs:
-                    self.videoDurationMs = eventMicroSecond
+            if eventType == MidiFileReader.TIME_SIGNATURE:
+                self.timeSignatures.append((tick, noteNumber, velocity))
+                continue
 
-                # skip note events that are outside our visible keyboard range
-                if not self.piano.startNote == "auto" and event.data[0] < int(self.piano.startNote):
-                    continue
+            if tick > maxNoteTick:
+                maxNoteTick = tick
 
-                if not self.piano.endNote == "auto" and event.data[0] > int(self.piano.endNote):
-                    continue
+            eventTicks.append(tick)
+            eventNotes.append(noteNumber)
+            # treat NoteOn with velocity=0 as NoteOff
+            eventVelocities.append(0 if eventType == MidiFileReader.NOTE_OFF else velocity)
+            eventChannels.append(channel)
+            eventTracks.append(trackNumber)
 
-                if event.data[0] < self.lowestFoundNoteNumber:
-                    self.lowestFoundNoteNumber = event.data[0]
+        self.tempoMap = TempoMap(midiFileReader.ticksPerBeat, tempoTicks, tempos)
+        self.videoDurationMs = float(self.tempoMap.ticksToMicroSeconds(numpy.asarray([maxNoteTick]))[0])
+        self.videoTotalFrames = int(math.ceil(self.videoDurationMs/1000000*self.framesPerSecond))
+        self.lastFrame = self.videoTotalFrames
+        self.stats.count('tempoChanges', len(tempos))
+        self.stats.addTime('midiParse', time.time() - parseStartTime)
+
+        eventSelections = self.selectKeyboardEvents(
+            numpy.frombuffer(eventNotes, dtype=numpy.uint8),
+            numpy.frombuffer(eventChannels, dtype=numpy.uint8),
+            numpy.frombuffer(eventTracks, dtype=numpy.uint16)
+        )
+        del eventTracks
+        eventTicks = numpy.frombuffer(eventTicks, dtype=numpy.int64)
+        eventTimes = self.tempoMap.ticksToMicroSeconds(numpy.concatenate([ eventTicks[selection] for selection, slotOffset in eventSelections ]))
+        del eventTicks
+        self.stats.count('noteEvents', len(eventTimes))
+        with self.stats.measure('timelineBuild'):
+            self.buildTimeline(
+                eventTimes,
+                # the note of the timeline is the slot of the keyboard: keyboard index * 128 + note number
+                numpy.concatenate([
+                    numpy.frombuffer(eventNotes, dtype=numpy.uint8)[selection] + numpy.uint16(slotOffset)
+                    for selection, slotOffset in eventSelections
+                ]),
+                numpy.concatenate([ numpy.frombuffer(eventVelocities, dtype=numpy.uint8)[selection] for selection, slotOffset in eventSelections ]),
+                numpy.concatenate([ numpy.frombuffer(eventChannels, dtype=numpy.uint8)[selection] for selection, slotOffset in eventSelections ])
+            )
+        self.notesCollected = True
 
-                if event.data[0] > self.highestFoundNoteNumber:
-                    self.highestFoundNoteNumber = event.data[0]
-                self.notesToProcess.append(tuple((eventMicroSecond, event)))
+    '''
+        returns (indexes of the events, slot offset) for each keyboard. events are shown
+        on every keyboard whose range, channels and tracks match. the range of the
+        keyboards with startNote/endNote = auto is taken from their events
+    '''
+    def selectKeyboardEvents(self, eventNotes, eventChannels, eventTracks):
+        eventSelections = []
+        for keyboardIndex, keyboard in enumerate(self.keyboards):
+            lowestNote = 0 if keyboard.piano.startNote == "auto" else int(keyboard.piano.startNote)
+            highestNote = 127 if keyboard.piano.endNote == "auto" else int(keyboard.piano.endNote)
+            # skip note events that are outside our visible keyboard range
+            selected = (eventNotes >= lowestNote) & (eventNotes <= highestNote)
+            # empty channels/tracks = all of them
+            if keyboard.channels:
+                selected &= numpy.isin(eventChannels, list(keyboard.channels))
+            if keyboard.tracks:
+                selected &= numpy.isin(eventTracks, list(keyboard.tracks))
+
+            selection = numpy.flatnonzero(selected)
+            if selection.size > 0:
+                keyboard.lowestFoundNoteNumber = min(keyboard.lowestFoundNoteNumber, int(eventNotes[selection].min()))
+                keyboard.highestFoundNoteNumber = max(keyboard.highestFoundNoteNumber, int(eventNotes[selection].max()))
+            eventSelections.append((selection, keyboardIndex * 128))
+
+        return eventSelections
 
-                #print ( eventMicroSecond, t, "Note", e.data[0], "on" if e.data[1] > 0 else "off" )
+    '''
+        pairs all note on/off events to a table of notes sorted by start time
+        with on time, off time, velocity and channel. the note is the slot of the
+        keyboard (keyboard index * 128 + note number). times are quantized to the
+        (1-based) frame number the event becomes visible in
+    '''
+    def buildTimeline(self, eventTimes, eventNotes, eventVelocities, eventChannels):
+        eventTimes = numpy.asarray(eventTimes, dtype=numpy.float64)
+        # tracks get merged so events have to be sorted. stable to keep the order of simultaneous events
+        timeOrder = numpy.argsort(eventTimes, kind='stable')
+        # events of each key in time order. any following event of the same key
+        # (a note off or a note on of an already sounding note) finishes a note
+        keyOrder = timeOrder[numpy.argsort(eventNotes[timeOrder], kind='stable')]
+        keyNotes = eventNotes[keyOrder]
+        nextTimes = numpy.append(eventTimes[keyOrder][1:], math.inf)
+        nextTimes[:-1][keyNotes[1:] != keyNotes[:-1]] = math.inf
+
+        noteOns = eventVelocities[keyOrder] > 0
+        eventRanks = numpy.empty(len(timeOrder), dtype=numpy.int64)
+        eventRanks[timeOrder] = numpy.arange(len(timeOrder))
+        noteEvents = keyOrder[noteOns]
+        noteOrder = numpy.argsort(eventRanks[noteEvents])
+        noteEvents = noteEvents[noteOrder]
+
+        timeline = Map({
+            'length': len(noteEvents),
+            'note': eventNotes[noteEvents],
+            'onTime': eventTimes[noteEvents],
+            'offTime': nextTimes[noteOns][noteOrder],
+            'velocity': eventVelocities[noteEvents],
+            'channel': eventChannels[noteEvents]
+        })
+        timeline.onFrame = self.microSecondsToFrameNumbers(timeline.onTime)
+        timeline.offFrame = self.microSecondsToFrameNumbers(timeline.offTime)
+        # order in which the notes are released
+        timeline.offOrder = numpy.argsort(timeline.offTime, kind='stable').astype(numpy.int32)
+        # together with onFrame (sorted as well) an interval index for random access
+        timeline.sortedOffFrame = timeline.offFrame[timeline.offOrder]
 
-        self.videoTotalFrames = int(math.ceil(self.videoDurationMs/1000000*self.framesPerSecond))
-        self.notesCollected = True
+        self.timeline = timeline
+        self.timelineOnCursor = 0
+        self.timelineOffCursor = 0
+
+    '''
+        random access into the timeline. sets the cursors, open notes and fade steps
+        to the state after the frame before given frame without replaying the frames
+        from the start. the next call of updateActiveNotesForFrame has to be for given frame
+    '''
+    def seekToFrame(self, frameNumber):
+        timeline = self.timeline
+        previousFrame = frameNumber - 1
+        self.getHighlightPalette()
+        self.timelineOnCursor = int(numpy.searchsorted(timeline.onFrame, previousFrame, side='right'))
+        self.timelineOffCursor = int(numpy.searchsorted(timeline.sortedOffFrame, previousFrame, side='right'))
+
+        # fade steps start with 1 in the frame of the event and are advanced after each frame
+        self.pressedKeys = 0
+        self.noteFadeIns = [0] * len(self.noteFadeIns)
+        for noteIndex in numpy.flatnonzero(timeline.offFrame[:self.timelineOnCursor] > previousFrame).tolist():
+            slot = int(timeline.note[noteIndex])
+            self.pressedKeys |= 1 << slot
+            self.noteFadeIns[slot] = previousFrame - int(timeline.onFrame[noteIndex]) + 2
+            self.noteLevels[slot] = self.slotVelocityLevels[slot][timeline.velocity[noteIndex]]
+
+        # only notes released within the last fade out frames are still fading
+        self.fadingKeys = 0
+        self.noteFadeOuts = [0] * len(self.noteFadeOuts)
+        fadeOutFrames = max(len(fadeOutSchedule) for fadeOutSchedules in self.slotFadeOutSchedules for fadeOutSchedule in fadeOutSchedules)
+        recentOffCursor = int(numpy.searchsorted(timeline.sortedOffFrame, previousFrame - fadeOutFrames, side='right'))
+        for noteIndex in timeline.offOrder[recentOffCursor:self.timelineOffCursor].tolist():
+            slot = int(timeline.note[noteIndex])
+            if not self.pressedKeys >> slot & 1:
+                self.fadingKeys |= 1 << slot
+                self.noteFadeOuts[slot] = previousFrame - int(timeline.offFrame[noteIndex]) + 2
+                self.noteLevels[slot] = self.slotVelocityLevels[slot][timeline.velocity[noteIndex]]
+
+    # frame numbers of the excerpt given by --start/--end
+    def resolveFrameRange(self):
+        frameDuration = 1000000/self.framesPerSecond
+        self.firstFrame = 1
+        self.lastFrame = self.videoTotalFrames
+        if self.rangeStart:
+            self.firstFrame = max(1, int(self.parseTimePosition(self.rangeStart) // frameDuration) + 1)
+        if self.rangeEnd:
+            self.lastFrame = min(self.videoTotalFrames, int(math.ceil(self.parseTimePosition(self.rangeEnd) / frameDuration)))
+
+    # seconds, [hh:]mm:ss(.fraction) or bar:N (the first bar is 1). returns microseconds
+    def parseTimePosition(self, position):
+        if position.startswith('bar:'):
+            barTick = self.getTickForBar(int(position[4:]))
+            return float(self.tempoMap.ticksToMicroSeconds(numpy.asarray([barTick]))[0])
+
+        seconds = 0
+        for part in position.split(':'):
+            seconds = seconds * 60 + float(part)
+        return seconds * 1000000
+
+    # time signature changes are expected at the start of a bar. 4/4 until the first one
+    def getTickForBar(self, bar):
+        if bar < 1:
+            raise ValueError('the first bar is bar:1')
+
+        ticksPerBeat = self.tempoMap.ticksPerBeat
+        segmentTick = 0
+        segmentBar = 1
+        ticksPerBar = ticksPerBeat * 4
+        for tick, numerator, denominatorPower in sorted(self.timeSignatures):
+            barsInSegment = math.ceil((tick - segmentTick) / ticksPerBar)
+            if segmentBar + barsInSegment > bar:
+                break
+            segmentBar += barsInSegment
+            segmentTick = tick
+            ticksPerBar = ticksPerBeat * 4 * numerator / 2 ** denominatorPower
+
+        return int(round(segmentTick + (bar - segmentBar) * ticksPerBar))
+
+    # an event becomes visible in the first frame that ends at or after the event
+    def microSecondsToFrameNumbers(self, microSeconds):
+        frameDuration = 1000000/self.framesPerSecond
+        frameNumbers = numpy.full(microSeconds.shape, self.videoTotalFrames + 1, dtype=numpy.int32)
+        finite = numpy.isfinite(microSeconds)
+        frameNumbers[finite] = numpy.maximum(numpy.ceil(microSeconds[finite] / frameDuration), 1)
+        return frameNumbers
 
     def createTempDir(self):
-        self.tempDir = Path('%s/temp-%s' % (self.scriptPath.resolve(), self.midiFile.name))
+        self.tempDir = Path('%s/temp-%s' % (self.outputDir.resolve(), self.midiFile.name))
         if self.tempDir.is_dir():
             rmtree(self.tempDir.resolve())
 
         self.tempDir.mkdir(parents=True, exist_ok=True)
 
     def createTempSubDirs(self):
+        self.piano.tempDir = self.tempDir
+        if self.frameCacheDir:
+            frameCacheDir = Path(self.frameCacheDir)
+            if not frameCacheDir.is_absolute():
+                frameCacheDir = Path('%s/%s' % (self.scriptPath.resolve(), self.frameCacheDir))
+            frameCacheDir.mkdir(parents=True, exist_ok=True)
+            self.frameCache = FrameCache(frameCacheDir, self.frameCacheMaxSize * 1024 * 1024)
+            self.frameCache.pin()
+
+        if self.useFrameStream() or self.frameCache:
+            # no single frame files in the temp dir needed
+            return
+
         self.tempDirFrames = Path('%s/frames' % (self.tempDir.resolve() ))
         self.tempDirFrames.mkdir(parents=True, exist_ok=True)
-
-        self.piano.tempDir = self.tempDir
         self.piano.tempDirFrames = self.tempDirFrames
 
-        # create a dir for every single (start) note to avoid filesystem boundries
-        for noteNumber in range(self.piano.startNote, self.piano.endNote+1):
-            noteDir = Path('%s/%s' % ( self.tempDirFrames.resolve(), noteNumber) )
-            noteDir.mkdir(parents=True, exist_ok=True)
+    # a raw frame stream has no timestamps. so variable frame rate requires the frame list
+    def useFrameStream(self):
+        # almost every frame of the piano roll is different. frame files would not be reused
+        if self.pianoRoll == '1':
+            return True
+        return self.streamFrames == '1' and self.variableFrameRate != '1' and not self.useEncodeSegments()
 
+    def useEncodeSegments(self):
+        return self.encodeSegments > 1 and self.variableFrameRate != '1'
 
     def createVideo(self):
+        # audio (if any) gets encoded and muxed by the same ffmpeg process as the frames
+        for output in self.outputs:
+            output.path = self.getOutputPath(output.encoder.container, output.name)
+        videoPath = self.outputs[0].path
+        profiler = None
+        if self.profileFile:
+            # render workers are separate processes and do not show up in the profile
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        if self.preview in ['still', 'sheet']:
+            videoPath = self.getOutputPath('png')
+            self.createPreviewImage(videoPath)
+        elif self.useFrameStream():
+            self.createVideoFromFrameStream()
+        else:
+            self.createVideoFromFrameFiles()
+
+        if self.pianoRollRenderer:
+            self.stats.count('pianoRollRowsDrawn', self.pianoRollRenderer.rowsDrawn)
+            self.stats.count('pianoRollRedraws', self.pianoRollRenderer.redraws)
+
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(str(self.profileFile))
+            logging.info("written profile of the frame loop to %s" % self.profileFile)
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+
+        self.finishAudioSynthesis()
+
+        if self.frameCache:
+            logging.info("frame cache: %i hits, %i misses" % (self.frameCache.hits, self.frameCache.misses))
+            self.stats.count('frameCacheHits', self.frameCache.hits)
+            self.stats.count('frameCacheMisses', self.frameCache.misses)
+            self.stats.count('frameCacheBytesWritten', self.frameCache.bytesWritten)
+            with self.stats.measure('frameCacheEvict'):
+                self.frameCache.evict(keepSince=self.runStartTime)
+            self.frameCache.unpin()
+
+        self.writeRunReport(videoPath)
+
+    # excerpts and previews never overwrite the video of the whole file
+    def getOutputPath(self, extension, outputName=''):
+        suffix = ''
+        if self.preview:
+            suffix = '.sheet' if self.preview == 'sheet' else '.preview'
+        elif self.firstFrame > 1 or self.lastFrame < self.videoTotalFrames:
+            suffix = '.excerpt'
+        if outputName:
+            suffix += '.%s' % outputName
+        return Path("%s/%s%s.%s" %( self.outputDir.resolve(), self.midiFile.name, suffix, extension ) )
+
+    '''
+        without [outputs] there is a single video with the size of [video] and the
+        [encoder] settings. otherwise frames are rendered once at the largest size
+        of all outputs and scaled down for the others
+    '''
+    def resolveOutputs(self):
+        self.outputs = []
+        for name, spec in self.outputSpecs:
+            size, *profile = spec.split()
+            width, height = [ int(value) for value in size.lower().split('x') ]
+            if width < 2 or height < 2 or width % 2 or height % 2:
+                raise ValueError("%s: width and height have to be even" % name)
+            encoder = self.encoder
+            if profile:
+                if profile[0] not in ENCODER_PROFILES:
+                    raise ValueError("%s: unknown encoder profile '%s'" % (name, profile[0]))
+                encoder = Map(ENCODER_PROFILES[profile[0]])
+            self.outputs.append(Map({ 'name': name, 'width': width, 'height': height, 'encoder': encoder }))
+
+        if not self.outputs:
+            self.outputs.append(Map({ 'name': '', 'width': self.videoWidth, 'height': self.videoHeight, 'encoder': self.encoder }))
+            return
+
+        largest = max(self.outputs, key=lambda output: output.width * output.height)
+        for output in self.outputs:
+            # the keys would be distorted otherwise
+            if abs(output.width / output.height - largest.width / largest.height) > 0.01 * largest.width / largest.height:
+                raise ValueError("%s: aspect ratio differs from %s" % (output.name, largest.name))
+        self.videoWidth = largest.width
+        self.videoHeight = largest.height
+
+    '''
+        a single frame at the start of the range or a contact sheet of frames evenly
+        distributed over the range. each frame is seeked to directly
+    '''
+    def createPreviewImage(self, imagePath):
         startTime = time.time()
-        frameDurationMs = 1000000/self.framesPerSecond
-        currentFrameStartMs = 0
-        reachedPercent = 0
+        highlightPalette = self.getHighlightPalette()
+        frameNumbers = [ self.firstFrame ]
+        if self.preview == 'sheet':
+            frameNumbers = sorted(set(numpy.linspace(
+                self.firstFrame, self.lastFrame, self.previewSheetFrames
+            ).round().astype(int).tolist()))
+
+        images = []
+        for frameNumber in frameNumbers:
+            self.seekToFrame(frameNumber)
+            self.updateActiveNotesForFrame(frameNumber)
+            highlightedNotes = tuple(
+                (slot, highlightPalette[colorIndex]) for slot, colorIndex in self.getFrameComposition()
+            )
+            if self.pianoRoll == '1':
+                frameData = self.rasterizeFrame(highlightedNotes, self.renderEngine == 'sprite')
+                frameData = self.getPianoRollFrame(frameNumber, frameData)
+                images.append(Image.frombytes('RGBA', (self.videoWidth, self.videoHeight), bytes(frameData)))
+                continue
+            images.append(Image.open(io.BytesIO(self.rasterizeFrame(highlightedNotes))))
+
+        gap = 4
+        columns = min(self.previewSheetColumns, len(images))
+        rows = int(math.ceil(len(images) / columns))
+        sheet = Image.new('RGBA', (
+            columns * (self.videoWidth + gap) - gap,
+            rows * (self.videoHeight + gap) - gap
+        ))
+        for imageIndex, image in enumerate(images):
+            sheet.paste(image, (
+                (imageIndex % columns) * (self.videoWidth + gap),
+                (imageIndex // columns) * (self.videoHeight + gap)
+            ))
+        sheet.save(imagePath)
+        self.stats.addTime('createPreviewImage', time.time() - startTime)
+        logging.info("written preview of %i frames to %s" % (len(images), imagePath))
 
-        frameFilePaths = []
-        for frameNum in range(1,self.videoTotalFrames+1):
-            reachedPercent = int(frameNum / (self.videoTotalFrames/100))
-            print ('create single frames: %i %%' % reachedPercent, end='\r' )
-            sys.stdout.flush()
-            currentFrameEndMs = currentFrameStartMs + frameDurationMs
-            self.updateActiveNotesForFrame(currentFrameEndMs)
-            frameFilePaths.append("file '%s'" % self.createFrameComposition( frameNum ).resolve())
-            currentFrameStartMs = currentFrameEndMs
+    '''
+        real-time mode. a frame clock emits frames at frameRate while note events
+        arrive from the live source. new key states are rendered in the background.
+        when rendering is slow the previous frame is repeated, when the output is slow
+        frames are dropped, so the latency stays bounded
+    '''
+    def createLiveVideo(self):
+        eventQueue = queue.SimpleQueue()
+        sourceThread = threading.Thread(target=self.readLiveSource, args=(eventQueue,), daemon=True)
+        renderer = LiveFrameRenderer(self.getFrameRenderer(), self.renderEngine == 'sprite')
+        highlightPalette = self.getHighlightPalette()
+        # before the clock starts. the first notes would be late otherwise
+        self.warmUpSprites()
+        renderer.submit((), [])
+        frameSink = self.openLiveSink()
+
+        frameDuration = 1 / self.framesPerSecond
+        latencies = []
+        eventTimes = []
+        renderedState = None
+        lastFrameData = None
+        sourceFinished = False
+        lastReportTime = time.monotonic()
+        renderer.start()
+        sourceThread.start()
+        startTime = time.monotonic()
+        frameNumber = 0
+        try:
+            while True:
+                frameNumber += 1
+                deadline = startTime + frameNumber * frameDuration
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                elif -delay > frameDuration:
+                    # the output could not keep up. skip the missed frames
+                    missedFrames = int(-delay / frameDuration)
+                    frameNumber += missedFrames
+                    self.stats.count('liveFramesDropped', missedFrames)
+
+                while True:
+                    try:
+                        noteEvent = eventQueue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if noteEvent is None:
+                        sourceFinished = True
+                        break
+                    receiveTime, slots, velocity = noteEvent
+                    if not slots:
+                        continue
+                    for slot in slots:
+                        if velocity > 0:
+                            self.pressNote(slot, velocity)
+                        elif self.pressedKeys >> slot & 1:
+                            self.releaseNote(slot)
+                    eventTimes.append(receiveTime)
+                    self.stats.count('liveNoteEvents')
+
+                frameState = self.getFrameComposition()
+                if frameState != renderedState:
+                    renderer.submit(
+                        tuple( (slot, highlightPalette[colorIndex]) for slot, colorIndex in frameState ),
+                        eventTimes
+                    )
+                    renderedState = frameState
+                    eventTimes = []
+
+                frameData, shownEventTimes = renderer.takeFrame()
+                if frameData is None:
+                    # the very first frame is not rendered yet
+                    continue
+                if frameData is lastFrameData:
+                    # rendering of the current state is not finished yet or nothing changed
+                    self.stats.count('liveFramesReused')
+                lastFrameData = frameData
+                if not self.writeLiveFrame(frameSink, frameData):
+                    break
+                self.stats.count('liveFramesWritten')
+                now = time.monotonic()
+                latencies += [ now - eventTime for eventTime in shownEventTimes ]
+
+                if now - lastReportTime > 5:
+                    lastReportTime = now
+                    self.logLiveMetrics(latencies)
+
+                if sourceFinished and not self.pressedKeys | self.fadingKeys and renderer.isIdle():
+                    break
+        except KeyboardInterrupt:
+            pass
+
+        renderer.stop()
+        self.closeLiveSink(frameSink)
+        self.stats.count('liveStatesSuperseded', renderer.supersededStates)
+        self.stats.addTime('liveRenderFrames', renderer.renderSeconds)
+        self.logLiveMetrics(latencies)
+        if latencies:
+            self.stats.count('liveLatencyAvgMs', float(numpy.mean(latencies)) * 1000)
+            self.stats.count('liveLatencyP95Ms', float(numpy.percentile(latencies, 95)) * 1000)
+            self.stats.count('liveLatencyMaxMs', float(numpy.max(latencies)) * 1000)
+        self.writeRunReport(self.liveOutput)
+
+    def logLiveMetrics(self, latencies):
+        logging.info("live: %i frames written, %i dropped, %i reused. latency avg %.1f ms, p95 %.1f ms" % (
+            self.stats.counters.get('liveFramesWritten', 0),
+            self.stats.counters.get('liveFramesDropped', 0),
+            self.stats.counters.get('liveFramesReused', 0),
+            numpy.mean(latencies) * 1000 if latencies else 0,
+            numpy.percentile(latencies, 95) * 1000 if latencies else 0
+        ))
 
-        frameFilePathsFile = Path("%s/singleFrameFileList.txt" % self.tempDir.resolve())
-        frameFilePathsFile.write_text(
-            '\n'.join(frameFilePaths)
+    '''
+        puts (receiveTime, slots of the keyboards, velocity) of each note event into the queue and
+        None at the end. a midi file is replayed at wall-clock speed, everything else is
+        read as raw midi bytes (fifo, device or tcp:host:port)
+    '''
+    def readLiveSource(self, eventQueue):
+        try:
+            if not self.liveStream:
+                self.replayTimeline(eventQueue)
+            elif self.liveSource.startswith('tcp:'):
+                host, port = self.liveSource[4:].rsplit(':', 1)
+                with socket.create_connection((host, int(port))) as connection:
+                    self.readRawMidi(lambda: connection.recv(4096), eventQueue)
+            else:
+                with open(self.liveSource, 'rb', buffering=0) as stream:
+                    self.readRawMidi(lambda: stream.read(4096), eventQueue)
+        except OSError as error:
+            print ( "ERROR: reading live source %s failed: %s" % (self.liveSource, error) )
+        eventQueue.put(None)
+
+    def readRawMidi(self, readChunk, eventQueue):
+        parser = RawMidiParser()
+        while True:
+            chunk = readChunk()
+            if not chunk:
+                return
+            receiveTime = time.monotonic()
+            for noteNumber, velocity, channel in parser.feed(chunk):
+                eventQueue.put((receiveTime, self.getLiveSlots(noteNumber, channel), velocity))
+
+    # slots of the keyboards that show a note of given channel. there are no tracks in live mode
+    def getLiveSlots(self, noteNumber, channel):
+        return tuple(
+            keyboardIndex * 128 + noteNumber for keyboardIndex, keyboard in enumerate(self.keyboards)
+            if keyboard.piano.keyLayoutByNote[noteNumber] and (not keyboard.channels or channel in keyboard.channels)
         )
 
-        logging.info("finished %s in %s seconds\r" % ( 'create single frames', '{0:.3g}'.format(time.time() - startTime) ) )
+    # stand-in for a device. releases of simultaneous events go first like in updateActiveNotesForFrame
+    def replayTimeline(self, eventQueue):
+        timeline = self.timeline
+        noteEvents = sorted(
+            [ (onTime, 1, slot, velocity) for onTime, slot, velocity in zip(
+                timeline.onTime.tolist(), timeline.note.tolist(), timeline.velocity.tolist()
+            ) ] +
+            [ (offTime, 0, slot, 0) for offTime, slot in zip(
+                timeline.offTime.tolist(), timeline.note.tolist()
+            ) if offTime != math.inf ]
+        )
+        startTime = time.monotonic()
+        for eventTime, isNoteOn, slot, velocity in noteEvents:
+            delay = startTime + eventTime / 1000000 - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            eventQueue.put((time.monotonic(), (slot,), velocity))
+
+    # raw:<path> writes raw rgba frames (path - is stdout). anything else is an ffmpeg output
+    def openLiveSink(self):
+        if self.liveOutput.startswith('raw:'):
+            rawOutput = self.liveOutput[4:]
+            if rawOutput == '-':
+                # the real stdout. sys.stdout is redirected to stderr in this mode
+                return Map({ 'stream': sys.__stdout__.buffer, 'videoStream': None })
+            return Map({ 'stream': open(rawOutput, 'wb'), 'videoStream': None })
+
+        output = self.liveOutput
+        if '://' not in output:
+            output = self.escapeArg(self.scriptPath / output)
+        # frames get their timestamps when they arrive. dropped frames become longer frames
+        cmd = [
+            'ffmpeg', '-y', '-f', 'rawvideo', '-pix_fmt', 'rgba',
+            '-s', '%dx%d' % (self.videoWidth, self.videoHeight),
+            '-use_wallclock_as_timestamps', '1', '-i', '-',
+            '-r', str(self.framesPerSecond), '-pix_fmt', 'yuv420p'
+        ]
+        if self.liveOutputFormat:
+            cmd += [ '-f', self.liveOutputFormat ]
+        videoStream = self.openVideoStream(cmd + [ output ], 'encode live frames')
+        return Map({ 'stream': videoStream.process.stdin, 'videoStream': videoStream })
+
+    # returns False when the sink has been closed by the reader
+    def writeLiveFrame(self, frameSink, frameData):
+        try:
+            frameSink.stream.write(frameData)
+        except BrokenPipeError:
+            return False
+        return True
+
+    def closeLiveSink(self, frameSink):
+        if frameSink.videoStream:
+            self.closeVideoStream(frameSink.videoStream)
+            return
+        try:
+            # stdout stays open for the rest of the process
+            if frameSink.stream is sys.__stdout__.buffer:
+                frameSink.stream.flush()
+            else:
+                frameSink.stream.close()
+        except BrokenPipeError:
+            pass
+
+    # machine readable summary of the run for job runners
+    def writeRunReport(self, videoPath):
+        if self.runReport != '1' and not self.reportFile:
+            return
+
+        reportFile = self.reportFile or Path("%s/%s.report.json" %( self.outputDir.resolve(),  self.midiFile.name ) )
+        report = {
+            'midiFile': str(self.midiFile.resolve()),
+            'videoFile': str(videoPath),
+            'width': self.videoWidth,
+            'height': self.videoHeight,
+            'frameRate': self.framesPerSecond,
+            'renderEngine': self.renderEngine,
+            'workers': self.workers,
+            'firstFrame': self.firstFrame,
+            'lastFrame': self.lastFrame,
+            'velocityLevels': [ int(keyboard.piano.velocityLevels) for keyboard in self.keyboards ]
+        }
+        if len(self.outputs) > 1:
+            report['videoFiles'] = [ str(output.path) for output in self.outputs ]
+        report.update(self.stats.getReport())
+        reportFile.write_text(json.dumps(report, indent=2))
+        logging.info("written run report to %s" % reportFile)
+
+    '''
+        fluidsynth renders raw pcm into a pipe in the background while the frames get
+        rendered. the final ffmpeg encode reads the other end of the pipe so there
+        are no intermediate audio files and no additional mux pass
+    '''
+    def startAudioSynthesis(self):
+        if self.addAudio != '1' or self.preview in ['still', 'sheet']:
+            return
 
-        videoWithoutAudioFile = Path("%s/video-noaudio.mp4" % self.tempDir.resolve())
+        midiFilePath = self.midiFile
+        if self.midiFileCopy:
+            midiFilePath = self.midiFileCopy
 
+        readFd, writeFd = os.pipe()
         cmd = [
-            'ffmpeg', '-y', '-f', 'concat', '-r', str(self.framesPerSecond),
-            '-safe', '0', '-i', self.escapeArg(frameFilePathsFile),
-            '-pix_fmt', 'yuv420p',
-            '-framerate', str(self.framesPerSecond),
-            self.escapeArg(videoWithoutAudioFile)
+            'fluidsynth', '-ni', '-T', 'raw', '-O', 's16', '-r', '44100',
+            '-o', 'audio.file.endian=little', '-F', '/dev/fd/%i' % writeFd,
+            str(self.soundFont), str(midiFilePath.resolve())
         ]
-        self.generalCmd(cmd, 'concat single frame pics to video')
+        description = 'render midi file to audio'
+        logging.info("starting %s" % description)
+        logging.debug(' '.join(cmd))
+        self.audioSynthesis = Map({
+            'description': description,
+            'log': tempfile.TemporaryFile(),
+            'readFd': readFd,
+            'startTime': time.time(),
+            'process': None
+        })
+        self.audioSynthesis.process = subprocess.Popen(
+            cmd,
+            stdout=self.audioSynthesis.log,
+            stderr=subprocess.STDOUT,
+            pass_fds=(writeFd,)
+        )
+        # ffmpeg has to see the end of the stream as soon as fluidsynth finishes
+        os.close(writeFd)
 
+    def getAudioInputArgs(self):
+        if not self.audioSynthesis:
+            return []
 
-        videoPath = Path("%s/%s.mp4" %( self.scriptPath.resolve(),  self.midiFile.name ) )
-        if config.get("video", "addAudio") == "1":
-            audioWav = Path("%s/audio.wav" % self.tempDir.resolve())
-            audioMp3 = Path("%s/audio.mp3" % self.tempDir.resolve())
-            midiFilePath = self.midiFile
-            if self.midiFileCopy:
-                midiFilePath = self.midiFileCopy
-            cmd = [
-                'fluidsynth', '-F', str(audioWav.resolve()),
-                str(self.soundFont), str(midiFilePath.resolve())
-            ]
-            self.generalCmd(cmd, 'convert midi file to audio.wav')
+        # fluidsynth always renders from the start. skip the audio before an excerpt
+        seekArgs = []
+        if self.firstFrame > 1:
+            seekArgs = [ '-ss', '%.6f' % ((self.firstFrame - 1) / self.framesPerSecond) ]
+        return seekArgs + [ '-f', 's16le', '-ar', '44100', '-ac', '2', '-i', 'pipe:%i' % self.audioSynthesis.readFd ]
 
-            cmd = [
-                'ffmpeg','-y','-i', self.escapeArg(audioWav),
-                '-vn', '-ar', '44100', '-ac', '2', '-b:a', '192k',
-                self.escapeArg(audioMp3)
+    # audioInput is the index of the audio input of the ffmpeg command
+    def getAudioOutputArgs(self, encoder, audioInput=1):
+        if not self.audioSynthesis:
+            return []
+
+        return [ '-map', '%i:a:0' % audioInput, '-c:a', encoder.audioCodec, '-b:a', '192k', '-shortest' ]
+
+    '''
+        output arguments of all videos. videoFilter applies to the frames of the first input
+        and outputArgs are added to each output. with several outputs the frames are
+        split and scaled by a filter graph, so they are decoded (or piped) only once
+    '''
+    def getEncodeOutputArgs(self, outputPaths, videoFilter=None, outputArgs=[], keyframeInterval=None, withAudio=True):
+        args = []
+        videoMaps = [ '0:v:0' ] * len(self.outputs)
+        if len(self.outputs) > 1:
+            filterGraph = '[0:v]%ssplit=%i%s' % (
+                videoFilter + ',' if videoFilter else '',
+                len(self.outputs),
+                ''.join( '[split%i]' % outputIndex for outputIndex in range(len(self.outputs)) )
+            )
+            for outputIndex, output in enumerate(self.outputs):
+                filterGraph += ';[split%i]scale=%i:%i:flags=lanczos[output%i]' % (outputIndex, output.width, output.height, outputIndex)
+            args = [ '-filter_complex', filterGraph ]
+            videoMaps = [ '[output%i]' % outputIndex for outputIndex in range(len(self.outputs)) ]
+        elif videoFilter:
+            args = [ '-vf', videoFilter ]
+
+        for output, videoMap, outputPath in zip(self.outputs, videoMaps, outputPaths):
+            args += [ '-map', videoMap ] + self.getVideoEncoderArgs(output.encoder, keyframeInterval) + outputArgs
+            if withAudio:
+                args += output.encoder.muxerArgs + self.getAudioOutputArgs(output.encoder)
+            args.append(self.escapeArg(outputPath))
+        return args
+
+    def getVideoEncoderArgs(self, encoder, keyframeInterval=None):
+        args = [ '-c:v', encoder.codec ]
+        if encoder.preset:
+            args += [ '-preset', encoder.preset ]
+        if encoder.crf:
+            args += [ '-crf', encoder.crf ]
+        if encoder.bitrate:
+            args += [ '-b:v', encoder.bitrate ]
+        if encoder.tune:
+            args += [ '-tune', encoder.tune ]
+        keyframeInterval = keyframeInterval or self.getKeyframeInterval(encoder)
+        if keyframeInterval:
+            args += [ '-g', str(keyframeInterval) ]
+        return args + encoder.codecArgs + [ '-pix_fmt', encoder.pixelFormat ]
+
+    # in frames. None for the default of the encoder
+    def getKeyframeInterval(self, encoder=None):
+        encoder = encoder or self.encoder
+        if encoder.keyframeInterval == '':
+            return None
+        return max(1, int(round(float(encoder.keyframeInterval) * self.framesPerSecond)))
+
+    def getAudioPassFds(self):
+        if not self.audioSynthesis:
+            return ()
+
+        return (self.audioSynthesis.readFd,)
+
+    def finishAudioSynthesis(self):
+        if not self.audioSynthesis:
+            return
+
+        retcode = self.audioSynthesis.process.poll()
+        os.close(self.audioSynthesis.readFd)
+        if retcode is None:
+            # with -shortest ffmpeg may stop reading before the end of the audio
+            self.audioSynthesis.process.terminate()
+            retcode = self.audioSynthesis.process.wait()
+        elif retcode != 0:
+            self.audioSynthesis.log.seek(0)
+            print ( "ERROR: %s did not complete successfully (error code is %s)" % (self.audioSynthesis.description, retcode) )
+            print (self.audioSynthesis.log.read().decode('utf-8'))
+        self.audioSynthesis.log.close()
+        self.stats.addCommand(self.audioSynthesis.description, time.time() - self.audioSynthesis.startTime, retcode)
+        logging.info("finished %s in %s seconds\r" % (
+            self.audioSynthesis.description,
+            '{0:.3g}'.format(time.time() - self.audioSynthesis.startTime)
+        ))
+        self.audioSynthesis = None
+
+    def createVideoFromFrameFiles(self):
+        self.collectFrameStates()
+
+        startTime = time.time()
+        missingStates = [ state for state in self.frameStates if not self.frameExists(state) ]
+        renderedFrames = self.renderFrameStates(missingStates, readCache=False)
+        for stateNum, state in enumerate(missingStates, 1):
+            self.printProgress('create single frames', stateNum, len(missingStates))
+            frameData = next(renderedFrames)
+            if not self.frameCache:
+                framePath = self.getFramePath(state)
+                framePath.parent.mkdir(exist_ok=True)
+                framePath.write_bytes(frameData)
+                self.stats.count('tempBytesWritten', len(frameData))
+        renderedFrames.close()
+
+        if self.holdFrames == '1':
+            frameFilePaths = self.getHoldFrameFileList()
+        else:
+            frameFilePaths = [
+                self.getConcatFileEntry(self.getFramePath(self.frameStates[stateIndex]).resolve())
+                for stateIndex in self.frameStateIndexes
             ]
-            self.generalCmd(cmd, 'convert wav to mp3')
+        frameFilePathsFile = Path("%s/singleFrameFileList.txt" % self.tempDir.resolve())
+        self.stats.count('tempBytesWritten', frameFilePathsFile.write_text(
+            '\n'.join(frameFilePaths)
+        ))
+
+        self.stats.addTime('createSingleFrames', time.time() - startTime)
+        logging.info("finished %s in %s seconds\r" % ( 'create single frames', '{0:.3g}'.format(time.time() - startTime) ) )
 
+        if self.useEncodeSegments():
+            self.encodeVideoInSegments()
+            return
+
+        outputPaths = [ output.path for output in self.outputs ]
+        if self.holdFrames == '1':
+            # timestamps are taken from the durations of the frame list
             cmd = [
-                'ffmpeg', '-y', '-i', self.escapeArg(videoWithoutAudioFile),
-                '-i', self.escapeArg(audioMp3), '-c', 'copy', '-map', '0:v:0', '-map', '1:a:0', '-shortest',
-                self.escapeArg(videoPath)
-            ]
-            self.generalCmd(cmd, 'merge mp3 stream into video')
+                'ffmpeg', '-y', '-f', 'concat',
+                '-safe', '0', '-i', self.escapeArg(frameFilePathsFile)
+            ] + self.getAudioInputArgs()
+            if self.variableFrameRate == '1':
+                cmd += self.getEncodeOutputArgs(outputPaths, outputArgs=[ '-vsync', 'vfr' ])
+            else:
+                cmd += self.getEncodeOutputArgs(
+                    outputPaths,
+                    videoFilter='fps=%s' % self.framesPerSecond,
+                    outputArgs=[ '-frames:v', str(len(self.frameStateIndexes)) ]
+                )
         else:
-            os.rename(videoWithoutAudioFile.resolve(), videoPath.resolve())
+            cmd = [
+                'ffmpeg', '-y', '-f', 'concat', '-r', str(self.framesPerSecond),
+                '-safe', '0', '-i', self.escapeArg(frameFilePathsFile)
+            ] + self.getAudioInputArgs() + self.getEncodeOutputArgs(
+                outputPaths,
+                outputArgs=[ '-framerate', str(self.framesPerSecond) ]
+            )
+        self.generalCmd(cmd, 'concat single frame pics to video', passFds=self.getAudioPassFds())
+
+    # frames are piped into a single running ffmpeg process as soon as they are rendered
+    # so encoding happens in parallel and no single frame files are written to disk
+    def createVideoFromFrameStream(self):
+        self.collectFrameStates()
 
+        startTime = time.time()
+        cmd = [ 'ffmpeg', '-y' ] + self.getFrameStreamInputArgs() + self.getAudioInputArgs() + self.getEncodeOutputArgs(
+            [ output.path for output in self.outputs ]
+        )
+        videoStream = self.openVideoStream(cmd, 'encode streamed frames to video', passFds=self.getAudioPassFds())
+
+        rawOutput = self.renderEngine == 'sprite'
+        renderedFrames = self.renderFrameStates(self.frameStates, rawOutput)
+        nextRenderedStateIndex = 0
+        for frameNum, stateIndex in enumerate(self.frameStateIndexes.tolist(), 1):
+            self.printProgress('render and encode frames', frameNum, len(self.frameStateIndexes))
+            if stateIndex in self.streamedFrames:
+                self.streamedFrames.move_to_end(stateIndex)
+                frameData = self.streamedFrames[stateIndex]
+                self.stats.count('streamedFrameHits')
+            else:
+                if stateIndex == nextRenderedStateIndex:
+                    # states are numbered by first appearance
+                    frameData = next(renderedFrames)
+                    nextRenderedStateIndex += 1
+                else:
+                    # already rendered but dropped from memory
+                    frameData = self.rasterizeFrame(self.frameStates[stateIndex][1], rawOutput)
+                    self.stats.count('framesRerendered')
+                self.rememberStreamedFrame(stateIndex, frameData)
+
+            if self.pianoRoll == '1':
+                frameData = self.getPianoRollFrame(self.firstFrame + frameNum - 1, frameData)
+            self.writeFrameToStream(videoStream, frameData)
+
+        # forked render workers inherit the pipe to ffmpeg. stop them before finishing the stream
+        renderedFrames.close()
+        self.closeVideoStream(videoStream)
+        self.stats.addTime('renderAndEncodeFrames', time.time() - startTime)
+        logging.info("finished %s in %s seconds\r" % ( 'render and encode frames', '{0:.3g}'.format(time.time() - startTime) ) )
+
+    # entry of an ffmpeg concat list. a quote in the path closes the quoting, is escaped and reopens it
+    def getConcatFileEntry(self, filePath):
+        return "file '%s'" % str(filePath).replace("'", "'\\''")
 
-    def getEventsUntilMs(self, microSecond):
-        collectedEvents = []
-        for event in self.notesToProcess:
-            if event[0] > microSecond:
-                break
-            #print ( "ts:%f no:%s na:%s %s vel:%s" % ( event[0] , event[1].data[0] , noteNumberToNoteName(event[1].data[0]), event[1].__class__.__name__, event[1].data[1], ) )
-            collectedEvents.append(event[1])
-            self.notesToProcess.remove(event)
-
-        return collectedEvents
-
-
-    def updateActiveNotesForFrame(self, frameEndMicroSec):
-        newEvents = self.getEventsUntilMs(frameEndMicroSec)
-        for newEvent in newEvents:
-            if (
-                newEvent.__class__.__name__ == "NoteOffEvent" or
-                # treat NoteOn with velocity=0 as NoteOff
-                (newEvent.__class__.__name__ == "NoteOnEvent" and newEvent.data[1] == "0")
-            ):
-                self.openNotes.pop(newEvent.data[0], None)
-                self.noteFadeOuts[str(newEvent.data[0])] = 1
+    '''
+        consecutive identical frames collapse into a single entry with a duration
+        so ffmpeg has to decode each key state only once
+    '''
+    def getHoldFrameFileList(self, frameStateIndexes=None):
+        if frameStateIndexes is None:
+            frameStateIndexes = self.frameStateIndexes
+        runStarts = numpy.flatnonzero(numpy.diff(frameStateIndexes, prepend=-1))
+        runLengths = numpy.diff(runStarts, append=len(frameStateIndexes))
+        frameFilePaths = []
+        for runStart, runLength in zip(runStarts.tolist(), runLengths.tolist()):
+            stateIndex = frameStateIndexes[runStart]
+            frameFilePaths.append(self.getConcatFileEntry(self.getFramePath(self.frameStates[stateIndex]).resolve()))
+            frameFilePaths.append("duration %.6f" % (runLength / self.framesPerSecond))
+
+        # the duration of the last entry is ignored. so repeat it at the start of the very last frame
+        if runLengths.size and runLengths[-1] > 1:
+            frameFilePaths[-1] = "duration %.6f" % ((runLengths[-1] - 1) / self.framesPerSecond)
+            frameFilePaths.append(frameFilePaths[-2])
+        elif runLengths.size:
+            frameFilePaths.pop()
+
+        logging.info("collapsed %i frames into %i hold frames" % (len(frameStateIndexes), len(runStarts)))
+        return frameFilePaths
+
+    '''
+        the frames get cut into segments at multiples of the keyframe interval. each segment
+        is encoded by its own ffmpeg process in parallel. the segments are joined by stream
+        copy and the audio gets added in the same pass
+    '''
+    def encodeVideoInSegments(self):
+        startTime = time.time()
+        frameCount = len(self.frameStateIndexes)
+        # all segments start with a keyframe anyway. with a fixed interval the joined
+        # video has the same keyframes as a single encode
+        keyframeInterval = self.getKeyframeInterval() or self.framesPerSecond * 10
+        keyframes = int(math.ceil(frameCount / keyframeInterval))
+        segmentCount = max(1, min(self.encodeSegments, keyframes))
+        boundaries = [ round(keyframes * segment / segmentCount) * keyframeInterval for segment in range(segmentCount) ] + [ frameCount ]
+        threads = self.encodeThreads
+        if threads == 'auto':
+            threads = max(1, (os.cpu_count() or 1) // segmentCount)
+
+        segmentDir = Path("%s/segments" % self.tempDir.resolve())
+        segmentDir.mkdir(exist_ok=True)
+        segmentCmds = []
+        # segment files of each output
+        segmentPaths = [ [] for output in self.outputs ]
+        for segment in range(segmentCount):
+            frameStateIndexes = self.frameStateIndexes[boundaries[segment]:boundaries[segment+1]]
+            frameFilePathsFile = Path("%s/frameList-%04d.txt" % (segmentDir, segment))
+            self.stats.count('tempBytesWritten', frameFilePathsFile.write_text(
+                '\n'.join(self.getHoldFrameFileList(frameStateIndexes))
+            ))
+            outputPaths = []
+            for outputIndex, output in enumerate(self.outputs):
+                outputPaths.append(Path("%s/segment-%04d-%i.%s" % (segmentDir, segment, outputIndex, output.encoder.container)))
+                segmentPaths[outputIndex].append(self.getConcatFileEntry(outputPaths[-1]))
+            segmentCmds.append(([
+                'ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', self.escapeArg(frameFilePathsFile)
+            ] + self.getEncodeOutputArgs(
+                outputPaths,
+                videoFilter='fps=%s' % self.framesPerSecond,
+                outputArgs=[ '-frames:v', str(len(frameStateIndexes)), '-threads', str(threads) ],
+                keyframeInterval=keyframeInterval,
+                withAudio=False
+            ), 'encode segment %i of %i' % (segment + 1, segmentCount)))
+
+        with multiprocessing.pool.ThreadPool(segmentCount) as pool:
+            pool.starmap(self.generalCmd, segmentCmds)
+        self.stats.count('encodeSegments', segmentCount)
+        self.stats.addTime('encodeSegments', time.time() - startTime)
+
+        # a single join for all outputs as the audio can only be read once
+        cmd = [ 'ffmpeg', '-y' ]
+        for outputIndex, output in enumerate(self.outputs):
+            segmentListFile = Path("%s/segmentList-%i.txt" % (segmentDir, outputIndex))
+            segmentListFile.write_text('\n'.join(segmentPaths[outputIndex]))
+            cmd += [ '-f', 'concat', '-safe', '0', '-i', self.escapeArg(segmentListFile) ]
+        cmd += self.getAudioInputArgs()
+        for outputIndex, output in enumerate(self.outputs):
+            cmd += [ '-map', '%i:v:0' % outputIndex, '-c:v', 'copy' ] + output.encoder.muxerArgs + (
+                self.getAudioOutputArgs(output.encoder, audioInput=len(self.outputs))
+            ) + [ self.escapeArg(output.path) ]
+        self.generalCmd(cmd, 'join %i segments to video' % segmentCount, passFds=self.getAudioPassFds())
+
+    def rememberStreamedFrame(self, stateIndex, frameData):
+        self.streamedFrames[stateIndex] = frameData
+        self.streamedFramesBytes += len(frameData)
+        while self.streamedFramesBytes > self.streamedFramesMaxBytes:
+            self.streamedFramesBytes -= len(self.streamedFrames.popitem(last=False)[1])
+
+    # only prints when the percentage changes
+    def printProgress(self, description, current, total):
+        percent = int(current / (total/100))
+        if description == self.progress.phase and percent == self.progress.percent:
+            return
+        self.progress.phase = description
+        self.progress.percent = percent
+        print ('%s: %i %%' % (description, percent), end='\r' )
+        sys.stdout.flush()
+
+    '''
+        first pass over the timeline. computes the key state of every frame
+        and deduplicates them, so that each unique state gets rendered only once
+    '''
+    def collectFrameStates(self):
+        startTime = time.time()
+        stateIndexByHash = {}
+        highlightPalette = self.getHighlightPalette()
+        self.frameStates = []
+        frameCount = self.lastFrame - self.firstFrame + 1
+        self.frameStateIndexes = numpy.zeros(frameCount, dtype=numpy.int32)
+        # the unique states as they would be without velocity levels. for the run report
+        loudestStates = None
+        if any(int(keyboard.piano.velocityLevels) > 1 for keyboard in self.keyboards):
+            loudestStates = set()
+        if self.firstFrame > 1:
+            self.seekToFrame(self.firstFrame)
+        # the loop is cheap per frame. progress only about every percent
+        progressInterval = max(1, frameCount // 100)
+        for frameNum in range(self.firstFrame, self.lastFrame+1):
+            if (frameNum - self.firstFrame + 1) % progressInterval == 0 or frameNum == self.lastFrame:
+                self.printProgress('collect frame states', frameNum - self.firstFrame + 1, frameCount)
+            self.updateActiveNotesForFrame(frameNum)
+            frameState = self.getFrameComposition()
+            if loudestStates is not None:
+                loudestStates.add(self.getLoudestFrameComposition(frameState))
+            if frameState not in stateIndexByHash:
+                stateIndexByHash[frameState] = len(self.frameStates)
+                # compact and picklable state descriptor with the colors for the renderers
+                highlightedNotes = tuple( (slot, highlightPalette[colorIndex]) for slot, colorIndex in frameState )
+                self.frameStates.append( (self.getFrameDigest(frameState), highlightedNotes) )
+            self.frameStateIndexes[frameNum-self.firstFrame] = stateIndexByHash[frameState]
+
+        self.stats.addTime('collectFrameStates', time.time() - startTime)
+        self.stats.count('totalFrames', frameCount)
+        self.stats.count('uniqueFrames', len(self.frameStates))
+        if loudestStates is not None:
+            self.stats.count('uniqueFramesWithoutVelocity', len(loudestStates))
+        logging.info("finished %s in %s seconds (%i unique of %i frames)\r" % (
+            'collect frame states',
+            '{0:.3g}'.format(time.time() - startTime),
+            len(self.frameStates),
+            frameCount
+        ))
+
+    '''
+        second pass. rasterizes given frame states and yields the frame data in the
+        same order. with more than one worker the states get rendered in parallel by a
+        process pool while the amount of frames waiting in memory stays limited
+        png frames are taken from and added to the persistent frame cache
+    '''
+    def renderFrameStates(self, frameStates, rawOutput=False, readCache=True):
+        frameRenderer = self.getFrameRenderer()
+        # composing raw frames from sprites is cheaper than reading and decoding pngs
+        frameCache = None if rawOutput else self.frameCache
+        if self.workers < 2 or len(frameStates) < 2:
+            for frameDigest, highlightedNotes in frameStates:
+                frameData = frameCache.read(frameDigest) if frameCache and readCache else None
+                if frameData is None:
+                    frameData = self.rasterizeFrame(highlightedNotes, rawOutput)
+                    if frameCache:
+                        frameCache.write(frameDigest, frameData)
+                yield frameData
+            return
+
+        # forked workers inherit the sprites. they stay in this process for the next files
+        self.warmUpSprites()
+        with multiprocessing.Pool(
+            self.workers,
+            initializer=initFrameRenderWorker,
+            initargs=(frameRenderer,)
+        ) as pool:
+            # (frameDigest, cached frame data or pending result of a worker)
+            pendingFrames = deque()
+            for frameDigest, highlightedNotes in frameStates:
+                frameData = frameCache.read(frameDigest) if frameCache and readCache else None
+                if frameData is None:
+                    frameData = pool.apply_async(renderFrameInWorker, ((highlightedNotes, rawOutput),))
+                pendingFrames.append((frameDigest, frameData))
+                if len(pendingFrames) >= self.workers * 4:
+                    yield self.getPendingFrame(pendingFrames.popleft(), frameCache)
+            while pendingFrames:
+                yield self.getPendingFrame(pendingFrames.popleft(), frameCache)
+
+    def getPendingFrame(self, pendingFrame, frameCache):
+        frameDigest, frameData = pendingFrame
+        if isinstance(frameData, bytes):
+            return frameData
+
+        frameData, seconds = frameData.get()
+        self.stats.addTime('rasterizeFrames', seconds)
+        self.stats.count('framesRasterized')
+        if frameCache:
+            frameCache.write(frameDigest, frameData)
+        return frameData
+
+    # svg2png or sprite composition of a single frame in this process
+    def rasterizeFrame(self, highlightedNotes, rawOutput=False):
+        with self.stats.measure('rasterizeFrames'):
+            frameData = self.getFrameRenderer().renderFrame(dict(highlightedNotes), rawOutput)
+        self.stats.count('framesRasterized')
+        return frameData
+
+    def getFrameRenderer(self):
+        if not self.frameRenderer:
+            for keyboard in self.keyboards:
+                keyboard.frameRenderer = FrameRenderer(
+                    keyboard.piano,
+                    self.videoWidth,
+                    keyboard.height,
+                    self.renderEngine,
+                    self.getKeyboardConfigDigest(keyboard)
+                )
+            self.frameRenderer = self.keyboards[0].frameRenderer
+            if len(self.keyboards) > 1:
+                self.frameRenderer = KeyboardStackRenderer(
+                    [ keyboard.frameRenderer for keyboard in self.keyboards ],
+                    self.videoWidth,
+                    self.videoHeight,
+                    self.renderEngine
+                )
+        return self.frameRenderer
+
+    '''
+        composes the piano roll above a rendered keyboard frame (raw rgba with the sprite
+        engine, png otherwise). returns raw rgba that is only valid until the next call.
+        the roll needs the whole timeline, so it is created on first use
+    '''
+    def getPianoRollFrame(self, frameNumber, keyboardFrame):
+        if not self.pianoRollRenderer:
+            self.pianoRollRenderer = PianoRollRenderer(
+                self.piano,
+                self.timeline,
+                self.videoWidth,
+                self.pianoRollRows,
+                float(self.pianoRollSeconds),
+                self.framesPerSecond,
+                self.pianoRollBackgroundColor,
+                self.pianoRollLineColor
+            )
+        with self.stats.measure('pianoRoll'):
+            if self.renderEngine != 'sprite':
+                keyboardFrame = Image.open(io.BytesIO(keyboardFrame)).convert('RGBA').tobytes()
+            return self.pianoRollRenderer.composeFrame(frameNumber, keyboardFrame)
+
+    # rasterizes the sprites of the idle and highlighted keys. fade colors follow when needed
+    def warmUpSprites(self):
+        if self.renderEngine != 'sprite':
+            return
+        highlightPalette = self.getHighlightPalette()
+        self.getFrameRenderer()
+        for keyboardIndex, keyboard in enumerate(self.keyboards):
+            compositor = keyboard.frameRenderer.getCompositor()
+            # the highlight color of each velocity level
+            highlightColors = [ highlightPalette[colorIndex] for colorIndex in self.slotHighlights[keyboardIndex * 128] ]
+            for key in keyboard.piano.keyLayout:
+                compositor.getSprite(key.noteNumber)
+                for highlightColor in highlightColors:
+                    compositor.getSprite(key.noteNumber, highlightColor)
+
+    # advances the timeline cursors by all note on/off events that are visible in given frame
+    # events are applied in chronological order. simultaneous release goes first to handle retriggered notes
+    def updateActiveNotesForFrame(self, frameNumber):
+        timeline = self.timeline
+        while True:
+            onIndex = self.timelineOnCursor
+            offIndex = -1
+            if self.timelineOffCursor < timeline.length:
+                offIndex = timeline.offOrder[self.timelineOffCursor]
+
+            noteOnDue = onIndex < timeline.length and timeline.onFrame[onIndex] <= frameNumber
+            # a note can only be released after it has been pressed
+            noteOffDue = 0 <= offIndex < onIndex and timeline.offFrame[offIndex] <= frameNumber
+
+            if noteOffDue and (not noteOnDue or timeline.offTime[offIndex] <= timeline.onTime[onIndex]):
+                self.releaseNote(int(timeline.note[offIndex]))
+                self.timelineOffCursor += 1
                 continue
 
-            self.openNotes[newEvent.data[0]] = newEvent.data[0]
-            self.noteFadeIns[str(newEvent.data[0])] = 1
-            self.noteFadeOuts.pop( str(newEvent.data[0]), None)
+            if not noteOnDue:
+                break
 
+            self.pressNote(int(timeline.note[onIndex]), int(timeline.velocity[onIndex]))
+            self.timelineOnCursor += 1
+
+    # key state changes shared by the timeline and live mode
+    def pressNote(self, slot, velocity):
+        self.pressedKeys |= 1 << slot
+        self.fadingKeys &= ~(1 << slot)
+        self.noteFadeIns[slot] = 1
+        self.noteFadeOuts[slot] = 0
+        self.noteLevels[slot] = self.slotVelocityLevels[slot][velocity]
+
+    def releaseNote(self, slot):
+        self.pressedKeys &= ~(1 << slot)
+        self.fadingKeys |= 1 << slot
+        self.noteFadeOuts[slot] = 1
+
+    # returns the key state of the current frame as tuple of (slot, palette index)
+    # the palette index covers the velocity level as well
+    # has to be called exactly once per frame as it advances the fade states
+    def getFrameComposition(self):
+        frameState = []
+        noteFadeIns = self.noteFadeIns
+        noteFadeOuts = self.noteFadeOuts
+        noteLevels = self.noteLevels
+        # set bits in ascending order of the slot
+        activeKeys = self.pressedKeys | self.fadingKeys
+        while activeKeys:
+            lowestBit = activeKeys & -activeKeys
+            activeKeys ^= lowestBit
+            slot = lowestBit.bit_length() - 1
+
+            fadeStep = noteFadeOuts[slot]
+            if fadeStep:
+                fadeOutSchedule = self.slotFadeOutSchedules[slot][noteLevels[slot]]
+                if fadeStep >= len(fadeOutSchedule):
+                    noteFadeOuts[slot] = 0
+                    self.fadingKeys ^= lowestBit
+                    continue
+                noteFadeOuts[slot] = fadeStep + 1
+                frameState.append((slot, fadeOutSchedule[fadeStep]))
+                continue
 
-    def createFrameComposition(self, frameNumber = 0):
-        sortedOpenNotes = {k: self.openNotes[k] for k in sorted(self.openNotes)}
-        compHash = "f"
+            colorIndex = self.slotHighlights[slot][noteLevels[slot]]
+            fadeStep = noteFadeIns[slot]
+            if fadeStep:
+                fadeInSchedule = self.slotFadeInSchedules[slot][noteLevels[slot]]
+                if fadeStep >= len(fadeInSchedule):
+                    noteFadeIns[slot] = 0
+                else:
+                    noteFadeIns[slot] = fadeStep + 1
+                    colorIndex = fadeInSchedule[fadeStep]
+            frameState.append((slot, colorIndex))
+
+        return tuple(frameState)
+
+    # the key state of the current frame as if every note had the loudest velocity level.
+    # reads the fade steps getFrameComposition advanced, so call it right after that
+    def getLoudestFrameComposition(self, frameState):
+        loudestState = []
+        for slot, colorIndex in frameState:
+            if self.noteFadeOuts[slot]:
+                colorIndex = self.slotFadeOutSchedules[slot][-1][self.noteFadeOuts[slot] - 1]
+            elif self.noteFadeIns[slot]:
+                colorIndex = self.slotFadeInSchedules[slot][-1][self.noteFadeIns[slot] - 1]
+            else:
+                colorIndex = self.slotHighlights[slot][-1]
+            loudestState.append((slot, colorIndex))
+        return tuple(loudestState)
 
-        for noteNumber in range(self.piano.startNote, self.piano.endNote+1):
-            offsetX = self.piano.getLeftOffsetForKeyPlacement(noteNumber)
-            isHighlight = False
-            highlightColor = ""
-            if noteNumber in sortedOpenNotes:
-                isHighlight = True
-                highlightColor = self.piano.colorHighlight
-                if str(noteNumber) in self.noteFadeIns:
-                    highlightColor = self.getColorForFadeIn(noteNumber)
-            if str(noteNumber) in self.noteFadeOuts:
-                highlightColor = self.getColorForFadeOut(noteNumber)
-
-            if highlightColor != "":
-                sortedOpenNotes[noteNumber] = highlightColor
-                compHash += str(noteNumber) + highlightColor + '-'
-
-        # TODO: create shorter hash as filename to avoid possible filename length limit
-        compPath = Path( '%s/%s.png'% (self.tempDirFrames.resolve(), compHash) )
-        if(len(sortedOpenNotes) > 0):
-            # separate directory for each first open note
-            firstOpenNote = str(next(iter(sortedOpenNotes)))
-            compPath = Path( '%s/%s/%s.png'% (self.tempDirFrames.resolve(),firstOpenNote, compHash) )
-
-        # don't create already existing identical frame pic again
-        if compPath.is_file():
-            return compPath
+    '''
+        fixed length identifier of a frame. covers everything that has an effect on the
+        pixels so identical frames of other midi files or runs can be reused
+    '''
+    def getFrameDigest(self, frameState):
+        return hashlib.sha1(('%s:%s' % (self.getRenderConfigDigest(), frameState)).encode('utf-8')).hexdigest()
+
+    # the digest of a single keyboard is the one of its frames. stacked keyboards combine theirs
+    def getRenderConfigDigest(self):
+        if not self.renderConfigDigest:
+            keyboardDigests = [ self.getKeyboardConfigDigest(keyboard) for keyboard in self.keyboards ]
+            self.renderConfigDigest = keyboardDigests[0]
+            if len(keyboardDigests) > 1:
+                self.renderConfigDigest = hashlib.sha1(repr(keyboardDigests).encode('utf-8')).hexdigest()
+
+        return self.renderConfigDigest
+
+    def getKeyboardConfigDigest(self, keyboard):
+        piano = keyboard.piano
+        renderConfig = [
+            self.renderEngine, self.videoWidth, keyboard.height, piano.svgTransform,
+            piano.colorWhiteKeys, piano.colorBlackKeys,
+            piano.outlineColorWhiteKeys, piano.outlineColorBlackKeys,
+            piano.outlineColorHighlight, self.getHighlightPalette()
+        ] + [ key.pathData for key in piano.keyLayout ]
+        return hashlib.sha1(repr(renderConfig).encode('utf-8')).hexdigest()
+
+    def getFramePath(self, frameState):
+        frameDigest = frameState[0]
+        if self.frameCache:
+            return self.frameCache.getPath(frameDigest)
+
+        return Path( '%s/%s/%s.png'% (self.tempDirFrames.resolve(), frameDigest[:2], frameDigest) )
+
+    def frameExists(self, frameState):
+        if self.frameCache:
+            return self.frameCache.contains(frameState[0])
+
+        return self.getFramePath(frameState).is_file()
+
+    # ffmpeg input arguments matching the frame data of the stream
+    def getFrameStreamInputArgs(self):
+        if self.renderEngine == 'sprite' or self.pianoRoll == '1':
+            return [
+                '-f', 'rawvideo', '-pix_fmt', 'rgba',
+                '-s', '%dx%d' % (self.videoWidth, self.videoHeight),
+                '-framerate', str(self.framesPerSecond), '-i', '-'
+            ]
 
-        pathStrings = []
-        for noteNumber in range(self.piano.startNote, self.piano.endNote+1):
-            offsetX = self.piano.getLeftOffsetForKeyPlacement(noteNumber)
-            highlightColor = ""
-            if noteNumber in sortedOpenNotes:
-                highlightColor = sortedOpenNotes[noteNumber]
-            pathStrings.append( self.piano.getSvgPathForNoteNumber(noteNumber, offsetX, highlightColor) )
+        return [
+            '-f', 'image2pipe', '-c:v', 'png',
+            '-framerate', str(self.framesPerSecond), '-i', '-'
+        ]
 
-        svgString = '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 %d %d">%s</svg>' % (
-            self.videoWidth,
-            self.videoHeight,
-            '\n'.join(pathStrings)
+    def openVideoStream(self, cmdArgsList, description, passFds=()):
+        logging.info("starting %s" % description)
+        logging.debug(' '.join(cmdArgsList))
+        # ffmpeg output goes to an anonymous temp file to avoid a full pipe buffer blocking the encoder
+        videoStream = Map({
+            'description': description,
+            'log': tempfile.TemporaryFile(),
+            'startTime': time.time(),
+            'process': None
+        })
+        videoStream.process = subprocess.Popen(
+            cmdArgsList,
+            stdin=subprocess.PIPE,
+            stdout=videoStream.log,
+            stderr=subprocess.STDOUT,
+            pass_fds=passFds
         )
-        svg2png( bytestring=svgString, write_to=self.escapeArg(compPath) )
-        return compPath
-
-
-    # TODO: does it make sense to limit fadeIn to NoteOff+NoteOn within very short time?
-    def getColorForFadeIn(self, noteNumber):
-        if self.noteFadeIn != '1':
-            return self.piano.colorHighlight
-
-        localFrameNum = self.noteFadeIns[str(noteNumber)]
-        self.noteFadeIns[str(noteNumber)] += 1
-        if localFrameNum < 4:
-            return self.piano.darkenColor(self.piano.colorHighlight, 0.2)
-        if localFrameNum < 5:
-            return self.piano.darkenColor(self.piano.colorHighlight, 0.1)
-
-        self.noteFadeIns.pop(str(noteNumber))
-        return self.piano.colorHighlight
-
-    # TODO: does it make sense to limit fadeOut to very short notes?
-    def getColorForFadeOut(self, noteNumber):
-        if self.noteFadeOut != '1':
-            return ''
-
-        localFrameNum = self.noteFadeOuts[str(noteNumber)]
-
-        self.noteFadeOuts[str(noteNumber)] += 1
-        # TODO based on chosen keycolor a "fade out" may be darken or lighten
-        # we assume we have white and black keys and no inverted colors...
-        multiplicator = 1 if self.piano.isWhiteKey(noteNumber) else -1
-        if localFrameNum < 2:
-            return self.piano.lightenColor(self.piano.colorHighlight, 0.4*multiplicator)
-        if localFrameNum < 4:
-            return self.piano.lightenColor(self.piano.colorHighlight, 0.5*multiplicator)
-        if localFrameNum < 8:
-            return self.piano.lightenColor(self.piano.colorHighlight, 0.6*multiplicator)
-        if localFrameNum < 10:
-            return self.piano.lightenColor(self.piano.colorHighlight, 0.8*multiplicator)
-
-        self.noteFadeOuts.pop(str(noteNumber))
-        return ""
-
-    def generalCmd(self, cmdArgsList, description, readStdError = False, silent=False):
+        return videoStream
+
+    def writeFrameToStream(self, videoStream, frameData):
+        try:
+            videoStream.process.stdin.write(frameData)
+            self.stats.count('streamBytesWritten', len(frameData))
+        except BrokenPipeError:
+            logTail = self.closeVideoStream(videoStream)
+            raise RuntimeError('%s exited: %s' % (videoStream.description, logTail))
+
+    # returns the last lines of the ffmpeg output if it failed
+    def closeVideoStream(self, videoStream):
+        try:
+            videoStream.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        retcode = videoStream.process.wait()
+        self.stats.addCommand(videoStream.description, time.time() - videoStream.startTime, retcode)
+        logTail = ''
+        if retcode != 0:
+            videoStream.log.seek(0)
+            log = videoStream.log.read().decode('utf-8', errors='replace')
+            print ( "ERROR: %s did not complete successfully (error code is %s)" % (videoStream.description, retcode) )
+            print (log)
+            logTail = ' '.join(log.strip().splitlines()[-3:])
+        videoStream.log.close()
+        return logTail
+
+    '''
+        the fade colors only depend on the highlight color, the fade step and the key color.
+        so they are computed once per configuration for each velocity level. index 0 of
+        the palette is the plain highlight color of the first keyboard (of its first level)
+    '''
+    def getHighlightPalette(self):
+        if self.highlightPalette:
+            return self.highlightPalette
+
+        palette = []
+        def getColorIndex(color):
+            if color not in palette:
+                palette.append(color)
+            return palette.index(color)
+
+        slotHighlights = []
+        slotFadeInSchedules = []
+        slotFadeOutSchedules = []
+        slotVelocityLevels = []
+        for keyboard in self.keyboards:
+            piano = keyboard.piano
+            highlightIndexes = []
+            fadeInSchedules = []
+            fadeOutSchedules = { True: [], False: [] }
+            for velocityColor in piano.getVelocityColors():
+                highlightIndexes.append(getColorIndex(velocityColor))
+
+                # TODO: does it make sense to limit fadeIn to NoteOff+NoteOn within very short time?
+                fadeInSchedule = ()
+                if self.noteFadeIn == '1':
+                    fadeInSchedule = (None,) + tuple(
+                        getColorIndex(piano.darkenColor(velocityColor, 0.2 if fadeStep < 4 else 0.1))
+                        for fadeStep in range(1, 5)
+                    )
+                fadeInSchedules.append(fadeInSchedule)
+
+                # TODO: does it make sense to limit fadeOut to very short notes?
+                # TODO based on chosen keycolor a "fade out" may be darken or lighten
+                # we assume we have white and black keys and no inverted colors...
+                for isWhite in (True, False):
+                    fadeOutSchedule = ()
+                    if self.noteFadeOut == '1':
+                        fadeOutSchedule = (None,) + tuple(
+                            getColorIndex(piano.getFadeOutColor(velocityColor, amount) if isWhite else piano.darkenColor(velocityColor, amount))
+                            for amount in [0.4, 0.5, 0.5, 0.6, 0.6, 0.6, 0.6, 0.8, 0.8]
+                        )
+                    fadeOutSchedules[isWhite].append(fadeOutSchedule)
+
+            fadeOutSchedules = { isWhite: tuple(schedules) for isWhite, schedules in fadeOutSchedules.items() }
+            velocityLevels = tuple( piano.getVelocityLevel(velocity) for velocity in range(128) )
+            slotHighlights += [ tuple(highlightIndexes) ] * 128
+            slotFadeInSchedules += [ tuple(fadeInSchedules) ] * 128
+            slotFadeOutSchedules += [ fadeOutSchedules[piano.isWhiteKey(noteNumber)] for noteNumber in range(128) ]
+            slotVelocityLevels += [ velocityLevels ] * 128
+
+        self.slotHighlights = tuple(slotHighlights)
+        self.slotFadeInSchedules = tuple(slotFadeInSchedules)
+        self.slotFadeOutSchedules = tuple(slotFadeOutSchedules)
+        self.slotVelocityLevels = tuple(slotVelocityLevels)
+        self.highlightPalette = tuple(palette)
+        return self.highlightPalette
+
+    def generalCmd(self, cmdArgsList, description, readStdError = False, silent=False, passFds=()):
         if not silent:
             logging.info("starting %s" % description)
         logging.debug(' '.join(cmdArgsList))
         sys.stdout.flush()
         startTime = time.time()
         if readStdError:
-            process = subprocess.Popen(cmdArgsList, stderr=subprocess.PIPE)
+            process = subprocess.Popen(cmdArgsList, stderr=subprocess.PIPE, pass_fds=passFds)
             processStdOut = process.stderr.read()
         else:
-            process = subprocess.Popen(cmdArgsList, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            process = subprocess.Popen(cmdArgsList, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, pass_fds=passFds)
             processStdOut = process.stdout.read()
         retcode = process.wait()
+        self.stats.addCommand(description, time.time() - startTime, retcode)
         if retcode != 0:
             print ( "ERROR: %s did not complete successfully (error code is %s)" % (description, retcode) )
             print (processStdOut.decode('utf-8'))
@@ -595,24 +2760,27 @@ class Midi2Video(object):
             sys.stdout.flush()
         return processStdOut.decode('utf-8')
 
+    # commands are run without a shell. so paths only need to be absolute, quoting would end up in the name
     def escapeArg(self, item):
         if item.__class__.__name__ == 'PosixPath':
             item = str(item.resolve())
 
-        return item.replace("'", "'\"'\"'")
+        return item
 
 
     # thanks to https://github.com/Pomax/arduino-midi-recorder/blob/master/fix.py
+    # MidiFileReader copes with wrong track lengths by itself. fluidsynth needs the fixed copy
     def fixTrackLengthBytes(self):
-        if self.fixTrackLength != '1':
+        if self.fixTrackLength != '1' or self.addAudio != '1':
             # disabled by config
             return
 
         # make a copy of the file. (keep things non-destructive)
-        self.midiFileCopy = Path(f"{self.tempDir}/{self.midiFile}.fixedlength.mid")
+        self.midiFileCopy = Path(f"{self.tempDir}/{self.midiFile.name}.fixedlength.mid")
         copyfile(self.midiFile, self.midiFileCopy)
         file = open(self.midiFileCopy, "rb+")
         file_size = os.path.getsize(self.midiFileCopy)
+        self.stats.count('tempBytesWritten', file_size)
         track_length = file_size - 22
 
         field_value = bytearray([
@@ -628,21 +2796,96 @@ class Midi2Video(object):
         logging.info(f"Updated {self.midiFileCopy} track length to {track_length}")
 
 def main():
-    global m2v, config
     logging.basicConfig(level=logging.INFO)
 
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '-i',
-        required=True,
         type=Path,
-        help='specifies the input midi file'
+        nargs='+',
+        help='specifies the input midi file(s). directories are searched for .mid/.midi files'
+    )
+    parser.add_argument(
+        '--jobs',
+        help='batch mode: amount of midi files rendered at the same time ("auto" or a number)'
+    )
+    parser.add_argument(
+        '--report',
+        type=Path,
+        help='write the json run report to this file. batch mode: summary with timings and failures'
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='profile the frame loop with cProfile and write it to <midi file>.prof'
+    )
+    parser.add_argument(
+        '--start',
+        type=parseTimeArgument,
+        help='start of an excerpt: seconds, [hh:]mm:ss or bar:N'
+    )
+    parser.add_argument(
+        '--end',
+        type=parseTimeArgument,
+        help='end of an excerpt: seconds, [hh:]mm:ss or bar:N'
+    )
+    parser.add_argument(
+        '--preview',
+        nargs='?',
+        const='video',
+        choices=PREVIEW_MODES,
+        help='fast preview with the settings of [preview]: a video, a single frame or a contact sheet'
+    )
+    parser.add_argument(
+        '--serve',
+        metavar='ADDRESS',
+        help='daemon mode: render jobs of a local http api on unix:<path>, <host>:<port> or a port on localhost'
+    )
+    parser.add_argument(
+        '--live',
+        metavar='SOURCE',
+        help='real-time mode: raw midi from a fifo, device or tcp:host:port. a midi file gets replayed'
     )
 
     args = parser.parse_args()
+    if not args.i and not args.live and not args.serve:
+        parser.error('one of the arguments -i, --live or --serve is required')
 
     scriptPath = Path(os.path.dirname(os.path.abspath(__file__)))
+    config = loadConfig(scriptPath)
+
+    options = Map({
+        'profile': args.profile,
+        'rangeStart': args.start,
+        'rangeEnd': args.end,
+        'preview': args.preview
+    })
+    if args.serve:
+        RenderDaemon(scriptPath, config).serve(args.serve)
+    elif args.live:
+        options.reportFile = args.report
+        if renderLive(scriptPath, config, args.live, options) != True:
+            print ( "exiting due to config errors..." )
+            sys.exit()
+    elif len(args.i) == 1 and not args.i[0].is_dir():
+        # TODO given arguments have highest priority override conf values again...
+        options.reportFile = args.report
+        try:
+            success = renderMidiFile(scriptPath, config, args.i[0], options=options)
+        except RuntimeError as error:
+            print ( "ERROR: %s" % error )
+            sys.exit(1)
+        if success != True:
+            print ( "exiting due to config errors..." )
+            sys.exit()
+    else:
+        jobs = args.jobs or config.get('batch', 'jobs', fallback='auto')
+        runBatch(scriptPath, config, collectMidiFiles(args.i), jobs, args.report, options)
+
+    print ( 'finished' )
+    sys.exit()
 
+def loadConfig(scriptPath):
     config = configparser.ConfigParser(strict=False)
     configFiles = [ '%s/m2v.conf' % scriptPath.resolve() ]
 
@@ -656,62 +2899,524 @@ def main():
     except configparser.ParsingError as parsingError:
         print ( 'parsing error %s' % str(parsingError) )
 
+    return config
 
+# renders a single midi file to video. returns False on config errors
+# options: reportFile, profile, rangeStart, rangeEnd, preview, outputDir
+# and onStart, which gets called with the Midi2Video instance before rendering
+def renderMidiFile(scriptPath, config, midiFile, workers=None, options=Map()):
+    if options.preview:
+        config = getPreviewConfig(config)
     m2v = Midi2Video(scriptPath, config)
-    m2v.midiFile = args.i
+    m2v.midiFile = midiFile
+    if options.outputDir:
+        m2v.outputDir = options.outputDir
+    m2v.reportFile = options.reportFile
+    m2v.rangeStart = options.rangeStart
+    m2v.rangeEnd = options.rangeEnd
+    m2v.preview = options.preview
+    if workers:
+        m2v.workers = workers
+    if options.profile:
+        m2v.profileFile = Path("%s/%s.prof" %( m2v.outputDir.resolve(), midiFile.name ) )
+    if options.onStart:
+        options.onStart(m2v)
 
     m2v.createTempDir()
     m2v.fixTrackLengthBytes()
-    # TODO given arguments have highest priority override conf values again...
 
-    if validateConfig() != True:
-        print ( "exiting due to config errors..." )
-        sys.exit()
+    if validateConfig(m2v, config) != True:
+        return False
 
-    m2v.createTempSubDirs()
-    m2v.createVideo()
+    try:
+        m2v.createTempSubDirs()
+        m2v.startAudioSynthesis()
+        m2v.createVideo()
+    finally:
+        # a failed run must not keep the frame cache pinned for the following files
+        if m2v.frameCache:
+            m2v.frameCache.unpin()
 
     # TODO parse debug conf for non removal of temp files
     #print (" removing temp files %s" % str(m2v.tempDir) )
     #rmtree(m2v.tempDir)
+    return True
 
-    print ( 'finished' )
-    sys.exit()
+# renders the notes of a live source in real time. returns False on config errors
+# a midi file as source gets replayed at its original speed
+def renderLive(scriptPath, config, source, options=Map()):
+    m2v = Midi2Video(scriptPath, config)
+    # raw frames on stdout. status and progress messages go to stderr instead of into the frames
+    if m2v.liveOutput == 'raw:-':
+        sys.stdout = sys.stderr
+    m2v.liveSource = source
+    m2v.liveStream = not Path(source).is_file()
+    m2v.midiFile = Path('live') if m2v.liveStream else Path(source)
+    # a single live output with the size of [video]. the piano roll would need the notes in advance
+    m2v.outputSpecs = []
+    m2v.pianoRoll = '0'
+    m2v.reportFile = options.reportFile
+    if validateConfig(m2v, config) != True:
+        return False
+
+    m2v.createLiveVideo()
+    return True
+
+# --preview: a video, a single frame or a contact sheet
+PREVIEW_MODES = ['video', 'still', 'sheet']
 
-def validateConfig():
-    if not m2v.midiFile.is_file():
+# syntax check of --start/--end and the start/end of daemon jobs. bars get resolved with the midi file
+def parseTimeArgument(position):
+    position = str(position)
+    try:
+        if position.startswith('bar:'):
+            if int(position[4:]) < 1:
+                raise ValueError
+        else:
+            for part in position.split(':'):
+                if not math.isfinite(float(part)):
+                    raise ValueError
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid time position '%s'. use seconds, [hh:]mm:ss or bar:N" % position)
+    return position
+
+# lower resolution and frame rate for quick checks of the configuration
+def getPreviewConfig(config):
+    previewConfig = configparser.ConfigParser(strict=False)
+    previewConfig.read_dict(config)
+    if not previewConfig.has_section('video'):
+        previewConfig.add_section('video')
+
+    scale = float(config.get('preview', 'scale', fallback=0.5))
+    for dimension, fallback in [('width', 800), ('height', 100)]:
+        # yuv420p requires even dimensions
+        size = int(int(config.get('video', dimension, fallback=fallback)) * scale) // 2 * 2
+        previewConfig.set('video', dimension, str(max(2, size)))
+    previewConfig.set('video', 'frameRate', config.get('preview', 'frameRate', fallback='10'))
+    previewConfig.set('video', 'addAudio', config.get('preview', 'addAudio', fallback='0'))
+    # a single preview video with the size of [video]
+    previewConfig.remove_section('outputs')
+    return previewConfig
+
+def collectMidiFiles(inputPaths):
+    midiFiles = []
+    for inputPath in inputPaths:
+        if not inputPath.is_dir():
+            midiFiles.append(inputPath)
+            continue
+        midiFiles += sorted(
+            filePath for filePath in inputPath.iterdir()
+            if filePath.is_file() and filePath.suffix.lower() in ['.mid', '.midi']
+        )
+    return midiFiles
+
+# each process of the batch pool parses the configuration only once and keeps its sprites
+batchScriptPath = None
+batchConfig = None
+batchFrameWorkers = None
+batchOptions = Map()
+
+def initBatchWorker(scriptPath, frameWorkers, options=Map()):
+    global batchScriptPath, batchConfig, batchFrameWorkers, batchOptions
+    batchScriptPath = scriptPath
+    batchConfig = loadConfig(scriptPath)
+    batchFrameWorkers = frameWorkers
+    batchOptions = options
+
+def renderBatchJob(midiFile):
+    startTime = time.time()
+    result = Map({ 'file': str(midiFile), 'success': False, 'seconds': 0, 'error': '' })
+    try:
+        if renderMidiFile(batchScriptPath, batchConfig, midiFile, batchFrameWorkers, batchOptions) == True:
+            result.success = True
+        else:
+            result.error = 'config errors'
+    # a broken file must never abort the whole batch
+    except (Exception, SystemExit) as error:
+        result.error = '%s: %s' % (error.__class__.__name__, error)
+
+    result.seconds = time.time() - startTime
+    return dict(result)
+
+'''
+    renders many midi files with a single startup. with more than one job the files
+    are distributed to a pool of processes. each file is rendered with a single
+    worker then. identical frames are shared via the frame cache and each process
+    reuses sprites of files with the same piano range and colors
+'''
+def runBatch(scriptPath, config, midiFiles, jobs, reportFile=None, options=Map()):
+    startTime = time.time()
+    if jobs == 'auto':
+        jobs = os.cpu_count() or 1
+    jobs = max(1, min(int(jobs), len(midiFiles) or 1))
+
+    results = []
+    batchFiles = []
+    # temp dirs and videos are named by the midi file name
+    knownNames = set()
+    for midiFile in midiFiles:
+        if midiFile.name in knownNames:
+            results.append({ 'file': str(midiFile), 'success': False, 'seconds': 0, 'error': 'duplicate file name' })
+            continue
+        knownNames.add(midiFile.name)
+        batchFiles.append(midiFile)
+
+    logging.info("starting batch of %i midi files with %i jobs" % (len(batchFiles), jobs))
+    if jobs < 2:
+        initBatchWorker(scriptPath, None, options)
+        for midiFile in batchFiles:
+            results.append(renderBatchJob(midiFile))
+    else:
+        with multiprocessing.Pool(jobs, initializer=initBatchWorker, initargs=(scriptPath, 1, options)) as pool:
+            for result in pool.imap_unordered(renderBatchJob, batchFiles):
+                results.append(result)
+                logging.info("finished %i of %i midi files" % (len(results), len(midiFiles)))
+
+    results.sort(key=lambda result: result['file'])
+    failures = [ result for result in results if not result['success'] ]
+
+    print ( '\nbatch summary:' )
+    for result in results:
+        print ( '%s %8.2fs  %s %s' % (
+            'ok  ' if result['success'] else 'FAIL',
+            result['seconds'],
+            result['file'],
+            result['error']
+        ))
+    print ( '%i of %i files rendered in %.2f seconds, %i failed' % (
+        len(results) - len(failures), len(results), time.time() - startTime, len(failures)
+    ))
+
+    if reportFile:
+        reportFile.write_text(json.dumps({
+            'seconds': time.time() - startTime,
+            'jobs': jobs,
+            'succeeded': len(results) - len(failures),
+            'failed': len(failures),
+            'files': results
+        }, indent=2))
+
+    return len(failures) == 0
+
+class RenderDaemon(object):
+    '''
+        long running render service. jobs are rendered one after another by a single
+        thread of this process. so the parsed configuration, the sprites of earlier jobs
+        with the same piano range and colors and the frame cache stay warm
+    '''
+    def __init__(self, scriptPath, config):
+        self.scriptPath = scriptPath
+        self.config = config
+        self.jobDir = Path(config.get('daemon', 'jobDir', fallback='daemon-jobs'))
+        if not self.jobDir.is_absolute():
+            self.jobDir = Path('%s/%s' % (scriptPath.resolve(), self.jobDir))
+        self.jobs = OrderedDict()
+        self.jobQueue = queue.Queue()
+        self.lock = threading.Lock()
+        self.nextJobId = 1
+
+    '''
+        request is a dict with either midiFile (a local path) or midiData (base64
+        encoded midi file) and name. optional: config ({ section: { key: value } }),
+        start, end and preview like the command line options
+    '''
+    def submitJob(self, request):
+        with self.lock:
+            jobId = str(self.nextJobId)
+            self.nextJobId += 1
+        job = Map({
+            'id': jobId,
+            'status': 'queued',
+            'request': request,
+            'outputDir': Path('%s/%s' % (self.jobDir, jobId)),
+            'submitTime': time.time(),
+            'seconds': 0,
+            'error': '',
+            'outputs': [],
+            'm2v': None
+        })
+        job.outputDir.mkdir(parents=True, exist_ok=True)
+        if request.get('midiData'):
+            job.midiFile = Path('%s/%s' % (job.outputDir, Path(request.get('name') or 'input.mid').name))
+            job.midiFile.write_bytes(base64.b64decode(request['midiData']))
+        else:
+            job.midiFile = Path(request.get('midiFile', ''))
+        self.jobs[jobId] = job
+        self.jobQueue.put(job)
+        return job
+
+    def runJobs(self):
+        while True:
+            job = self.jobQueue.get()
+            # one broken job must never stop the queue
+            try:
+                self.runJob(job)
+            except Exception as error:
+                job.status = 'failed'
+                job.error = job.error or '%s: %s' % (error.__class__.__name__, error)
+                logging.exception("job %s failed" % job.id)
+
+    def runJob(self, job):
+        startTime = time.time()
+        job.status = 'running'
+        try:
+            config = configparser.ConfigParser(strict=False)
+            config.read_dict(self.config)
+            config.read_dict({
+                section: { key: str(value) for key, value in values.items() }
+                for section, values in job.request.get('config', {}).items()
+            })
+            options = Map({
+                'rangeStart': job.request.get('start'),
+                'rangeEnd': job.request.get('end'),
+                'preview': job.request.get('preview'),
+                'outputDir': job.outputDir,
+                'onStart': lambda m2v: job.update({ 'm2v': m2v })
+            })
+            if not job.midiFile.is_file():
+                raise ValueError("input midifile '%s' does not exist" % job.midiFile)
+            if renderMidiFile(self.scriptPath, config, job.midiFile, options=options) == True:
+                job.status = 'finished'
+            else:
+                job.status = 'failed'
+                job.error = 'config errors'
+        # a broken job must never stop the daemon
+        except (Exception, SystemExit) as error:
+            job.status = 'failed'
+            job.error = '%s: %s' % (error.__class__.__name__, error)
+
+        if job.m2v and job.m2v.tempDir:
+            rmtree(job.m2v.tempDir, ignore_errors=True)
+        job.outputs = sorted(
+            str(filePath) for filePath in job.outputDir.iterdir()
+            if filePath.is_file() and filePath != job.midiFile
+        )
+        job.seconds = time.time() - startTime
+        logging.info("job %s %s in %s seconds" % (job.id, job.status, '{0:.3g}'.format(job.seconds)))
+
+    def getJobStatus(self, job):
+        status = {
+            'id': job.id,
+            'status': job.status,
+            'midiFile': str(job.midiFile),
+            'seconds': job.seconds if job.status in ['finished', 'failed'] else time.time() - job.submitTime,
+            'error': job.error,
+            'outputs': job.outputs
+        }
+        if job.m2v and job.status == 'running':
+            status['progress'] = dict(job.m2v.progress)
+        if job.m2v and job.status != 'running':
+            status['report'] = job.m2v.stats.getReport()
+        return status
+
+    # address is unix:<path>, <host>:<port> or a port on localhost
+    def serve(self, address):
+        daemon = self
+
+        class RequestHandler(DaemonRequestHandler):
+            renderDaemon = daemon
+
+        if address.startswith('unix:'):
+            socketPath = Path(address[5:])
+            if socketPath.is_socket():
+                socketPath.unlink()
+            server = UnixHTTPServer(str(socketPath), RequestHandler)
+        else:
+            host, _, port = address.rpartition(':')
+            server = http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)), RequestHandler)
+
+        threading.Thread(target=self.runJobs, daemon=True).start()
+        logging.info("render daemon listening on %s" % address)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class DaemonRequestHandler(http.server.BaseHTTPRequestHandler):
+    '''
+        POST /jobs       submit a job (json, see RenderDaemon.submitJob)
+        GET  /jobs       status of all jobs
+        GET  /jobs/<id>  status, progress, output files and run report of a job
+    '''
+    renderDaemon = None
+
+    def do_GET(self):
+        jobs = self.renderDaemon.jobs
+        if self.path.rstrip('/') == '/jobs':
+            self.sendJson(200, [ self.renderDaemon.getJobStatus(job) for job in list(jobs.values()) ])
+        elif self.path.startswith('/jobs/') and self.path[6:] in jobs:
+            self.sendJson(200, self.renderDaemon.getJobStatus(jobs[self.path[6:]]))
+        else:
+            self.sendJson(404, { 'error': 'not found' })
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            self.sendJson(404, { 'error': 'not found' })
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if not isinstance(request, dict) or not (request.get('midiFile') or request.get('midiData')):
+                raise ValueError('midiFile or midiData is required')
+            jobConfig = request.get('config', {})
+            if not isinstance(jobConfig, dict) or not all(isinstance(values, dict) for values in jobConfig.values()):
+                raise ValueError('config must be { section: { key: value } }')
+            if request.get('preview') and request['preview'] not in PREVIEW_MODES:
+                raise ValueError('preview must be one of %s' % ', '.join(PREVIEW_MODES))
+            # the same checks as for the command line options
+            for option in ['start', 'end']:
+                if request.get(option) is not None:
+                    request[option] = parseTimeArgument(request[option])
+            job = self.renderDaemon.submitJob(request)
+        except (ValueError, argparse.ArgumentTypeError) as error:
+            self.sendJson(400, { 'error': str(error) })
+            return
+        self.sendJson(202, self.renderDaemon.getJobStatus(job))
+
+    def sendJson(self, statusCode, data):
+        body = json.dumps(data, indent=2).encode('utf-8')
+        self.send_response(statusCode)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # unix sockets have no client address
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+def validateConfig(m2v, config):
+    if not m2v.liveStream and not m2v.midiFile.is_file():
         msg = "input midifile \'%s\' does not exist" % m2v.midiFile.resolve()
         raise argparse.ArgumentTypeError(msg)
 
-    startNote = config.get('piano', 'startNote')
-    endNote = config.get('piano', 'endNote')
+    for keyboard in m2v.keyboards:
+        if not keyboard.piano.velocityLevels.isdigit() or not 1 <= int(keyboard.piano.velocityLevels) <= 127:
+            print( " invalid velocityLevels '%s' in [%s]. use a number from 1 to 127" % (keyboard.piano.velocityLevels, keyboard.section))
+            return False
+        if keyboard.channels is None:
+            print( " invalid channels '%s' in [%s]. use numbers from 1 to 16 separated by comma" % (keyboard.channelsSetting, keyboard.section))
+            return False
+        if keyboard.tracks is None:
+            print( " invalid tracks '%s' in [%s]. use track numbers (the first track is 1) separated by comma" % (keyboard.tracksSetting, keyboard.section))
+            return False
 
-    if startNote == 'auto' or endNote == 'auto':
+    autoRange = any(keyboard.piano.startNote == 'auto' or keyboard.piano.endNote == 'auto' for keyboard in m2v.keyboards)
+    if m2v.liveStream:
+        # nothing to analyze. "auto" shows the 88 keys of a piano
+        for keyboard in m2v.keyboards:
+            keyboard.lowestFoundNoteNumber = 21
+            keyboard.highestFoundNoteNumber = 108
+    elif autoRange:
         m2v.prepareNoteEvents()
 
-    if startNote == 'auto':
-        m2v.piano.startNote = m2v.lowestFoundNoteNumber
+    for keyboard in m2v.keyboards:
+        piano = keyboard.piano
+        if (piano.startNote == 'auto' or piano.endNote == 'auto') and keyboard.lowestFoundNoteNumber > keyboard.highestFoundNoteNumber:
+            # "auto" has no range to show
+            if keyboard.channels or keyboard.tracks:
+                print( " no notes match channels/tracks of [%s]. check config..." % keyboard.section)
+            else:
+                print( " the midi file contains no notes for startNote/endNote = auto of [%s]" % keyboard.section)
+            return False
+        if piano.startNote == 'auto':
+            piano.startNote = keyboard.lowestFoundNoteNumber
 
-    if endNote == 'auto':
-        m2v.piano.endNote = m2v.highestFoundNoteNumber
+        if piano.endNote == 'auto':
+            piano.endNote = keyboard.highestFoundNoteNumber
 
-    m2v.piano.startNote = int(m2v.piano.startNote)
-    m2v.piano.endNote = int(m2v.piano.endNote)
-    if not m2v.notesCollected:
+        piano.startNote = int(piano.startNote)
+        piano.endNote = int(piano.endNote)
+    if not m2v.notesCollected and not m2v.liveStream:
         m2v.prepareNoteEvents()
 
 
-    # ensure we have enclosed white keys
-    if m2v.piano.isWhiteKey(m2v.piano.startNote) == False:
-        m2v.piano.startNote -= 1
-    if m2v.piano.isWhiteKey(m2v.piano.endNote) == False:
-        m2v.piano.endNote += 1
+    for keyboard in m2v.keyboards:
+        piano = keyboard.piano
+        # ensure we have enclosed white keys
+        if piano.isWhiteKey(piano.startNote) == False:
+            piano.startNote -= 1
+        if piano.isWhiteKey(piano.endNote) == False:
+            piano.endNote += 1
 
-    if m2v.piano.endNote <= m2v.piano.startNote:
-        print( " quirks in piano key range (startNote/endNote). check config...")
-        sys.exit()
+        if piano.endNote <= piano.startNote:
+            print( " quirks in piano key range (startNote/endNote) of [%s]. check config..." % keyboard.section)
+            return False
 
-    m2v.piano.calculateSvgDimensions(m2v.videoWidth, m2v.videoHeight)
+    try:
+        m2v.resolveOutputs()
+    except ValueError as error:
+        print( " invalid [outputs] %s. use name = WIDTHxHEIGHT [encoder profile]" % error)
+        return False
+
+    m2v.pianoRollRows = 0
+    if m2v.pianoRoll == '1':
+        if len(m2v.keyboards) > 1:
+            print( " the piano roll can not be combined with several keyboards")
+            return False
+        try:
+            m2v.pianoRollRows = int(m2v.videoHeight * float(m2v.pianoRollHeight) / 100)
+            if float(m2v.pianoRollSeconds) <= 0 or not 0 < m2v.pianoRollRows < m2v.videoHeight:
+                raise ValueError()
+        except ValueError:
+            print( " invalid [pianoRoll] height '%s' or seconds '%s'. use a percentage of the video height and seconds" % (m2v.pianoRollHeight, m2v.pianoRollSeconds))
+            return False
+
+    # keyboards share the height of the video below the piano roll
+    keyboardCount = len(m2v.keyboards)
+    keyboardsHeight = m2v.videoHeight - m2v.pianoRollRows
+    if keyboardsHeight < keyboardCount:
+        print( " the video height is too small for %i keyboards" % keyboardCount)
+        return False
+    for keyboardIndex, keyboard in enumerate(m2v.keyboards):
+        keyboard.height = keyboardsHeight * (keyboardIndex + 1) // keyboardCount - keyboardsHeight * keyboardIndex // keyboardCount
+        keyboard.piano.calculateSvgDimensions(m2v.videoWidth, keyboard.height)
+
+    try:
+        if not m2v.liveStream:
+            m2v.resolveFrameRange()
+    except ValueError as error:
+        print( " invalid --start/--end: %s. use seconds, [hh:]mm:ss or bar:N" % error)
+        return False
+    if (m2v.rangeStart or m2v.rangeEnd) and m2v.lastFrame < m2v.firstFrame:
+        print( " the excerpt given by --start/--end contains no frames")
+        return False
+
+    if m2v.encoderProfile not in ENCODER_PROFILES:
+        print( " invalid encoder profile '%s'. use one of %s" % (m2v.encoderProfile, ', '.join(ENCODER_PROFILES)))
+        return False
+    try:
+        m2v.getKeyframeInterval()
+    except ValueError:
+        print( " invalid keyframeInterval '%s'. use seconds" % m2v.encoder.keyframeInterval)
+        return False
+
+    if m2v.renderEngine not in ['sprite', 'svg']:
+        print( " invalid renderEngine '%s'. use 'sprite' or 'svg'" % m2v.renderEngine)
+        return False
+
+    if m2v.workers == 'auto':
+        m2v.workers = os.cpu_count() or 1
+    try:
+        m2v.workers = max(1, int(m2v.workers))
+    except ValueError:
+        print( " invalid workers '%s'. use 'auto' or a number" % m2v.workers)
+        return False
+
+    if m2v.encodeSegments == 'auto':
+        m2v.encodeSegments = os.cpu_count() or 1
+    try:
+        m2v.encodeSegments = max(1, int(m2v.encodeSegments))
+        if m2v.encodeThreads != 'auto':
+            m2v.encodeThreads = max(1, int(m2v.encodeThreads))
+    except ValueError:
+        print( " invalid encodeSegments '%s' or encodeThreads '%s'. use 'auto' or a number" % (m2v.encodeSegments, m2v.encodeThreads))
+        return False
 
     # TODO: check if ffmpeg is available
     # TODO: force video dimensions beeing dividable by 2